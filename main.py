@@ -1,51 +1,86 @@
 import json
 import os
 import inspect
+import logging
+import pickle
+from copy import deepcopy
 from functools import partial
 
 import numpy as np
+import sklearn
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import OneHotEncoder, MinMaxScaler
 from sklearn.metrics import pairwise_distances
-import tensorflow as tf
-tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
-import keras.backend
-#import tensorflow.keras.backend
+from sklearn.neighbors import KDTree
 
 from nnattack.variables import auto_var
+from nnattack.attacks.base import PerturbationSet
+from nnattack.cache import (
+    ObjectCache, hash_key, pack_rng_state, unpack_rng_state, source_digest,
+)
+
+logger = logging.getLogger(__name__)
+
+# fitted models of the previous runs, their arrays are memory-mapped
+MODEL_CACHE = ObjectCache('models')
 
 
 def set_random_seed(auto_var):
     random_seed = auto_var.get_var("random_seed")
-
-    tf.set_random_seed(random_seed)
     np.random.seed(random_seed)
 
-    config = tf.ConfigProto()
-    config.gpu_options.allow_growth = True
-    sess = tf.Session(config=config)
-    keras.backend.set_session(sess)
-    keras.layers.core.K.set_learning_phase(0)
-    #tensorflow.keras.backend.set_session(sess)
-    sess.run(tf.global_variables_initializer())
-    auto_var.set_intermidiate_variable("sess", sess)
+    # the tensorflow session is created by get_session when a model or
+    # attack needs it
+    auto_var.inter_var.pop("sess", None)
     random_state = np.random.RandomState(auto_var.get_var("random_seed"))
     auto_var.set_intermidiate_variable("random_state", random_state)
 
     return random_state
 
-def baseline_pert(model, trnX, tstX, tsty, perts, ord, constraint=None):
-    pred_trn = model.predict(trnX)
+class NearestOppositeBaseline():
+    """Closest training point the model predicts as another class, with one
+    KDTree per predicted class built once.
+
+    Arguments:
+        model -- fitted model with a predict method
+        trnX {ndarray, shape=(n_samples, n_features)} -- Training data
+        ord {int} -- Order of the norm, 1, 2 or np.inf
+    """
+    def __init__(self, model, trnX, ord):
+        metric = {1: 'manhattan', 2: 'euclidean', np.inf: 'chebyshev'}[ord]
+        pred_trn = model.predict(trnX)
+        self.trees = []
+        for c in np.unique(pred_trn):
+            ind = np.where(pred_trn == c)[0]
+            self.trees.append((c, ind, KDTree(trnX[ind], metric=metric)))
+
+    def query(self, X, y):
+        """Distance and index of the closest training point predicted as
+        another class than y, inf and -1 if there is none."""
+        dist = np.full(len(X), np.inf)
+        idx = -np.ones(len(X), dtype=int)
+        for c, ind, tree in self.trees:
+            rows = np.where(y != c)[0]
+            if len(rows) == 0:
+                continue
+            d, i = tree.query(X[rows], k=1)
+            closer = d[:, 0] < dist[rows]
+            dist[rows[closer]] = d[closer, 0]
+            idx[rows[closer]] = ind[i[closer, 0]]
+        return dist, idx
+
+def baseline_pert(model, trnX, tstX, tsty, perts, ord, constraint=None,
+        baseline=None):
+    correct = (model.predict(tstX + perts) == tsty)
+    if baseline is None:
+        baseline = NearestOppositeBaseline(model, trnX, ord)
+    dist, idx = baseline.query(tstX, tsty)
+    replace = np.logical_and(correct, idx != -1)
+    if constraint is not None:
+        replace = np.logical_and(replace, dist <= constraint)
     ret = np.copy(perts)
-    for i in np.where(model.predict(tstX + perts) == tsty)[0]:
-        tX = trnX[pred_trn != tsty[i]]
-        if len(tX) == 0:
-            continue
-        norms = np.linalg.norm(tX - tstX[i], ord=ord, axis=1)
-        if constraint is not None and norms.min() > constraint:
-            continue
-        ret[i] = tX[norms.argmin()] - tstX[i]
-    return ret, (model.predict(tstX + perts) == tsty).sum()
+    ret[replace] = trnX[idx[replace]] - tstX[replace]
+    return ret, correct.sum()
 
 
 def pass_random_state(fn, random_state):
@@ -53,28 +88,157 @@ def pass_random_state(fn, random_state):
         return partial(fn, random_state=random_state)
     return fn
 
+def is_eps_masked(perturbs, perts, eps_list, ord):
+    """Whether every perturbation of the sweep is perts with the rows whose
+    norm exceeds eps set to zero."""
+    norms = np.linalg.norm(perts, axis=1, ord=ord)
+    for pert, eps in zip(perturbs, eps_list):
+        if not np.array_equal(pert, np.where((norms <= eps)[:, np.newaxis], perts, 0)):
+            return False
+    return True
+
+def eps_sweep_accuracy(model, X, y, perts, eps_list, ord):
+    """Accuracy for every eps when the perturbation of a sample is either perts
+    or zero, from two predictions and the sorted perturbation norms."""
+    norms = np.linalg.norm(perts, axis=1, ord=ord)
+    order = np.argsort(norms)
+    correct_clean = (model.predict(X) == y)[order]
+    correct_pert = (model.predict(X + perts) == y)[order]
+    # number of correct samples among the i smallest perturbations
+    cum_clean = np.concatenate(([0], np.cumsum(correct_clean)))
+    cum_pert = np.concatenate(([0], np.cumsum(correct_pert)))
+
+    ret = []
+    for eps, k in zip(eps_list, np.searchsorted(norms[order], eps_list, side='right')):
+        ret.append({
+            'eps': eps,
+            'tst_acc': float((cum_pert[k] + cum_clean[-1] - cum_clean[k]) / len(y)),
+        })
+    return ret
+
 def estimate_model_roubstness(model, X, y, perturbs, eps_list, ord,
-        with_baseline=False, trnX=None):
+        with_baseline=False, trnX=None, perts=None, baseline=None):
     assert len(eps_list) == len(perturbs), (eps_list, perturbs.shape)
+    if isinstance(perturbs, PerturbationSet) and perturbs.ord == ord \
+            and list(perturbs.eps_list) == list(eps_list):
+        # masked by construction
+        masked, perts = True, perturbs.perts
+    else:
+        masked = perts is not None and is_eps_masked(perturbs, perts, eps_list, ord)
+    if masked and not with_baseline:
+        return eps_sweep_accuracy(model, X, y, perts, eps_list, ord)
+
+    if masked:
+        norms = np.linalg.norm(perts, axis=1, ord=ord)
+        correct_clean = (model.predict(X) == y)
+        correct_pert = (model.predict(X + perts) == y)
+    if with_baseline:
+        assert trnX is not None
+        if baseline is None:
+            baseline = NearestOppositeBaseline(model, trnX, ord)
+        base_dist, base_idx = baseline.query(X, y)
+        has_base = (base_idx != -1)
+        correct_base = np.zeros(len(X), dtype=bool)
+        if np.any(has_base):
+            base_pert = trnX[base_idx[has_base]] - X[has_base]
+            correct_base[has_base] = (model.predict(X[has_base] + base_pert) == y[has_base])
+
     ret = []
     for i, eps in enumerate(eps_list):
-        assert np.all(np.linalg.norm(perturbs[i], axis=1, ord=ord) <= (eps + 1e-6)), (np.linalg.norm(perturbs[i], axis=1, ord=ord), eps)
-        if with_baseline:
-            assert trnX is not None
-            pert, _ = baseline_pert(model, trnX, X, y, perturbs[i], ord, eps)
-            temp_tstX = X + pert
+        if masked:
+            correct = np.where(norms <= eps, correct_pert, correct_clean)
         else:
-            temp_tstX = X + perturbs[i]
+            assert np.all(np.linalg.norm(perturbs[i], axis=1, ord=ord) <= (eps + 1e-6)), (np.linalg.norm(perturbs[i], axis=1, ord=ord), eps)
+            correct = (model.predict(X + perturbs[i]) == y)
 
-        pred = model.predict(temp_tstX)
+        if with_baseline:
+            # still correct samples with a training point of another
+            # predicted class within eps are moved onto it
+            replace = np.logical_and(correct, base_dist <= eps)
+            correct = np.where(replace, correct_base, correct)
 
         ret.append({
             'eps': eps_list[i],
-            'tst_acc': (pred == y).mean().astype(float),
+            'tst_acc': correct.mean().astype(float),
         })
     return ret
 
-def eps_accuracy(auto_var):
+def model_reads_attack(model_name):
+    """Whether fitting the model reads the attack variable: adversarial
+    training (adv_ and the get_aug_data adv2_ models) perturbs the training
+    set with it, and the xvalid models score their candidates with it."""
+    return model_name.startswith(('adv_', 'adv2_')) or 'xvalid' in model_name
+
+def model_group_key(params):
+    """Grid points with the same key share the dataset split and the fitted
+    model of prepare_experiment, so they only differ by the attack.
+
+    The attack is part of the key for the models that read it when fitted
+    (see model_reads_attack).
+    """
+    model_name = params['model']
+    attack = params['attack'] if model_reads_attack(model_name) else None
+    return (params['dataset'], params['ord'], model_name,
+            params['random_seed'], attack)
+
+def fit_model(auto_var, trnX, trny, eps_list):
+    """The model of auto_var fitted on trnX, trny, from MODEL_CACHE if it
+    was fitted before.
+
+    The key is the training split, the model_group_key of the experiment,
+    the sources of nnattack.models (and of nnattack.attacks for the models
+    that read the attack), the sklearn version and the state of
+    the global numpy random generator, whose state after the fit is restored
+    on a hit. Models holding a tensorflow session are not cached.
+    """
+    model_name = auto_var.get_variable_name("model")
+    attack_name = auto_var.get_variable_name("attack")
+    if 'mlp' in model_name or 'logistic' in model_name:
+        auto_var.set_intermidiate_variable("eps_list", eps_list)
+
+    subpackages = ('models', 'attacks') if model_reads_attack(model_name) else ('models', )
+    key = hash_key(trnX, trny, list(model_group_key(auto_var.var_value)),
+                   source_digest(*subpackages), sklearn.__version__, pack_rng_state())
+    entry = MODEL_CACHE.get(key, mmap_mode='c')
+    if entry is not None:
+        unpack_rng_state(entry['rng_state'])
+        for name in entry['inter_var_names']:
+            auto_var.set_intermidiate_variable(name, entry['model'])
+        return entry['model']
+
+    if 'adv_rf' in model_name:
+        pre_model = auto_var.get_var_with_argument('model', model_name[4:])
+        pre_model.fit(trnX, trny)
+        if 'blackbox' in attack_name:
+            auto_var.set_intermidiate_variable("model", pre_model)
+    elif 'adv_nn' in model_name and 'blackbox' in attack_name:
+        pre_model = auto_var.get_var_with_argument('model', model_name[4:])
+        pre_model.fit(trnX, trny)
+        auto_var.set_intermidiate_variable("model", pre_model)
+
+    model = auto_var.get_var("model")
+    auto_var.set_intermidiate_variable("model", model)
+    model.fit(trnX, trny)
+
+    if not hasattr(model, 'sess'):
+        try:
+            # the registry also exposes the model as other intermediate
+            # variables, e.g. tree_clf for the tree attacks
+            inter_var_names = [name for name, value in auto_var.inter_var.items()
+                               if value is model]
+            MODEL_CACHE.set(key, {'model': model, 'rng_state': pack_rng_state(),
+                                  'inter_var_names': inter_var_names})
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            logger.warning(f"{model_name} is not cached, {e}")
+    return model
+
+def prepare_experiment(auto_var):
+    """Loads and splits the dataset and fits the model of an experiment.
+
+    Returns:
+        dict -- the state run_attack starts from, with the partial result
+            'ret' and 'done' set if there is nothing to attack
+    """
     random_state = set_random_seed(auto_var)
     ord = auto_var.get_var("ord")
 
@@ -119,22 +283,7 @@ def eps_accuracy(auto_var):
     auto_var.set_intermidiate_variable("trny", trny)
 
     model_name = auto_var.get_variable_name("model")
-    attack_name = auto_var.get_variable_name("attack")
-    if 'adv_rf' in model_name:
-        pre_model = auto_var.get_var_with_argument('model', model_name[4:])
-        pre_model.fit(trnX, trny)
-        if 'blackbox' in attack_name:
-            auto_var.set_intermidiate_variable("model", pre_model)
-    elif 'adv_nn' in model_name and 'blackbox' in attack_name:
-        pre_model = auto_var.get_var_with_argument('model', model_name[4:])
-        pre_model.fit(trnX, trny)
-        auto_var.set_intermidiate_variable("model", pre_model)
-    elif 'mlp' in model_name or 'logistic' in model_name:
-        auto_var.set_intermidiate_variable("eps_list", eps_list)
-
-    model = auto_var.get_var("model")
-    auto_var.set_intermidiate_variable("model", model)
-    model.fit(trnX, trny)
+    model = fit_model(auto_var, trnX, trny, eps_list)
     ret['trnX_len'] = len(trnX)
 
     pred = model.predict(tstX)
@@ -149,7 +298,7 @@ def eps_accuracy(auto_var):
         ret['tst_score'] = (model.predict(ori_tstX) == ori_tsty).mean()
         if ('adv' in model_name) or ('advPruning' in model_name) or ('robustv2' in model_name):
             ret['aug_len'] = len(model.augX)
-        return ret
+        return {'ret': ret, 'done': True}
         #raise ValueError("didn't got 100 testing examples")
 
     augX = None
@@ -161,6 +310,36 @@ def eps_accuracy(auto_var):
 
     if augX is not None:
         ret['aug_len'] = len(augX)
+    ret['tst_score'] = (model.predict(ori_tstX) == ori_tsty).mean()
+
+    return {
+        'ret': ret, 'done': False, 'ord': ord, 'model': model,
+        'trnX': trnX, 'tstX': tstX, 'tsty': tsty, 'eps_list': eps_list,
+        'inter_var': dict(auto_var.inter_var),
+        'random_state': random_state.get_state(),
+        'np_random_state': np.random.get_state(),
+    }
+
+def run_attack(auto_var, prepared):
+    """Attacks the fitted model of prepare_experiment with the attack of
+    auto_var and returns the result of the experiment.
+
+    The intermediate variables and the random states are restored as
+    prepare_experiment left them, so a prepared experiment can be attacked
+    any number of times with the same outcome as separate runs.
+    """
+    ret = deepcopy(prepared['ret'])
+    if prepared['done']:
+        return ret
+    for k, v in prepared['inter_var'].items():
+        auto_var.set_intermidiate_variable(k, v)
+    random_state = np.random.RandomState()
+    random_state.set_state(prepared['random_state'])
+    auto_var.set_intermidiate_variable("random_state", random_state)
+    np.random.set_state(prepared['np_random_state'])
+
+    ord, model, eps_list = prepared['ord'], prepared['model'], prepared['eps_list']
+    trnX, tstX, tsty = prepared['trnX'], prepared['tstX'], prepared['tsty']
 
     if len(tsty) != 100 or \
        (np.unique(auto_var.get_intermidiate_variable('trny'))[0] != None and \
@@ -172,11 +351,11 @@ def eps_accuracy(auto_var):
         attack_model = auto_var.get_var("attack")
         tst_perturbs = attack_model.perturb(tstX, y=tsty, eps=eps_list)
 
-    ret['tst_score'] = (model.predict(ori_tstX) == ori_tsty).mean()
-
     #########
+    attack_perts = None
     if attack_model is not None and hasattr(attack_model, 'perts'):
         perts = attack_model.perts
+        attack_perts = np.copy(perts)
     else:
         perts = np.zeros_like(tstX)
         for pert in tst_perturbs:
@@ -186,7 +365,10 @@ def eps_accuracy(auto_var):
                     perts[i] = pert[i]
 
     perts = perts.astype(float)
-    perts, missed_count = baseline_pert(model, trnX, tstX, tsty, perts, ord)
+    # the training predictions and the KDTrees are shared by both baselines
+    baseline = NearestOppositeBaseline(model, trnX, ord)
+    perts, missed_count = baseline_pert(model, trnX, tstX, tsty, perts, ord,
+                                        baseline=baseline)
     if len(np.unique(model.predict(trnX))) > 1:
         assert (model.predict(tstX + perts) == tsty).sum() == 0, model.predict(tstX + perts) == tsty
     else:
@@ -199,16 +381,22 @@ def eps_accuracy(auto_var):
     #########
 
     results = estimate_model_roubstness(
-        model, tstX, tsty, tst_perturbs, eps_list, ord, with_baseline=False)
+        model, tstX, tsty, tst_perturbs, eps_list, ord, with_baseline=False,
+        perts=attack_perts)
     ret['results'] = results
     baseline_results = estimate_model_roubstness(
-        model, tstX, tsty, tst_perturbs, eps_list, ord, with_baseline=True, trnX=trnX)
+        model, tstX, tsty, tst_perturbs, eps_list, ord, with_baseline=True, trnX=trnX,
+        perts=attack_perts, baseline=baseline)
     ret['baseline_results'] = baseline_results
 
     print(json.dumps(auto_var.var_value))
     print(json.dumps(ret))
     return ret
 
+def eps_accuracy(auto_var):
+    return run_attack(auto_var, prepare_experiment(auto_var))
+
+
 def main():
     auto_var.parse_argparse()
     auto_var.run_single_experiment(eps_accuracy)
@@ -4,6 +4,8 @@ import numpy as np
 
 from autovar.base import RegisteringChoiceType, VariableClass, register_var
 
+from ..tf_session import get_session
+
 class AttackVarClass(VariableClass, metaclass=RegisteringChoiceType):
     """Defines which attack method to use."""
     var_name = "attack"
@@ -68,7 +70,7 @@ class AttackVarClass(VariableClass, metaclass=RegisteringChoiceType):
         """Gradient Based Extension"""
         from .nns.gradient_based import GradientBased
         return GradientBased(
-                   sess=auto_var.inter_var['sess'],
+                   sess=get_session(auto_var),
                    trnX=auto_var.inter_var['trnX'],
                    trny=auto_var.inter_var['trny'],
                    ord=auto_var.get_var('ord'),
@@ -87,7 +89,8 @@ class AttackVarClass(VariableClass, metaclass=RegisteringChoiceType):
             n_neighbors=n_neighbors,
             n_searches=-1,
             ord=auto_var.get_var('ord'),
-            n_jobs=8
+            n_jobs=8,
+            n_init_cons=20,
         )
 
     @register_var(argument=r"kernelsub_c(?P<c>\d+)_(?P<attack>[a-zA-Z0-9]+)")
@@ -97,7 +100,7 @@ class AttackVarClass(VariableClass, metaclass=RegisteringChoiceType):
         from .kernel_sub_tf import KernelSubTf
         c = float(c) * 0.0001
         attack_model = KernelSubTf(
-            sess=inter_var['sess'],
+            sess=get_session(auto_var),
             attack=attack,
             ord=auto_var.get_var('ord'),
             c=c,
@@ -183,6 +186,22 @@ class AttackVarClass(VariableClass, metaclass=RegisteringChoiceType):
         )
         return attack_model
 
+    @register_var(argument=r"MILP_RF", shown_name="MILP")
+    @staticmethod
+    def milp_rf(auto_var, var_value, inter_var):
+        """Exact attack for Random Forest solved as a MILP"""
+        from .trees.rf_attack import RFAttack
+
+        attack_model = RFAttack(
+            trnX=inter_var['trnX'],
+            trny=inter_var['trny'],
+            method='milp',
+            clf=inter_var['tree_clf'],
+            ord=auto_var.get_var('ord'),
+            random_state=inter_var['random_state'],
+        )
+        return attack_model
+
     @register_var(argument=r"RBA_Approx_RF(?P<n_searches>_\d+)?",
                   shown_name="RBA-Approx")
     @staticmethod
@@ -8,6 +8,8 @@ from cvxopt import matrix, solvers
 import cvxopt.glpk
 import cvxopt
 
+from .base import PerturbationSet
+
 solvers.options['maxiters'] = 30
 solvers.options['show_progress'] = False
 solvers.options['refinement'] = 0
@@ -158,13 +160,7 @@ class ADAAttack():
                 pert_X[sample_id, :] = pert_x # pylint: disable=unsupported-assignment-operation
         
         if isinstance(eps, list):
-            rret = []
-            norms = np.linalg.norm(pert_X, axis=1, ord=self.ord)
-            for ep in eps:
-                t = np.copy(pert_X)
-                t[norms > ep, :] = 0
-                rret.append(t)
-            return rret
+            return PerturbationSet(pert_X, eps, self.ord)
         elif eps is not None:
             pert_X[np.linalg.norm(pert_X, axis=1, ord=self.ord) > eps, :] = 0 # pylint: disable=unsupported-assignment-operation
             return pert_X
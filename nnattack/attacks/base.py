@@ -3,6 +3,54 @@ from abc import abstractmethod
 import numpy as np
 
 
+class PerturbationSet():
+    """Perturbations of a sweep of eps values sharing one perturbation array.
+
+    The perturbation of eps is perts with the samples whose norm is larger
+    than eps set to zero. It is only built when accessed, so a sweep costs
+    one array instead of one copy per eps.
+
+    Arguments:
+        perts {ndarray, shape=(n_samples, ...)} -- Minimal perturbation of each sample
+        eps_list {list of float} -- The eps of the sweep
+        ord {int} -- Order of the norm
+    """
+    def __init__(self, perts, eps_list, ord, norms=None):
+        self.perts = np.asarray(perts)
+        self.eps_list = list(eps_list)
+        self.ord = ord
+        if norms is None:
+            norms = np.linalg.norm(self.perts.reshape((len(self.perts), -1)),
+                                   axis=1, ord=ord)
+        self.norms = norms
+
+    def get_eps(self, eps):
+        """Perturbation with the samples of norm larger than eps zeroed."""
+        mask = (self.norms <= eps).reshape((-1,) + (1,) * (self.perts.ndim - 1))
+        return np.where(mask, self.perts, 0).astype(self.perts.dtype, copy=False)
+
+    @property
+    def shape(self):
+        return (len(self.eps_list),) + self.perts.shape
+
+    def __len__(self):
+        return len(self.eps_list)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return PerturbationSet(self.perts, self.eps_list[i], self.ord,
+                                   norms=self.norms)
+        return self.get_eps(self.eps_list[i])
+
+    def __iter__(self):
+        for eps in self.eps_list:
+            yield self.get_eps(eps)
+
+    def __array__(self, dtype=None, copy=None):
+        ret = np.stack(list(self)) if len(self) else np.zeros(self.shape, self.perts.dtype)
+        return ret if dtype is None else ret.astype(dtype)
+
+
 class AttackModel():
 
     def __init__(self, ord):
@@ -11,13 +59,7 @@ class AttackModel():
 
     def _pert_with_eps_constraint(self, pert_X, eps):
         if isinstance(eps, list):
-            rret = []
-            norms = np.linalg.norm(pert_X, axis=1, ord=self.ord)
-            for ep in eps:
-                t = np.copy(pert_X)
-                t[norms > ep, :] = 0
-                rret.append(t)
-            return rret
+            return PerturbationSet(pert_X, eps, self.ord)
         elif eps is not None:
             pert_X[np.linalg.norm(pert_X, axis=1, ord=self.ord) > eps, :] = 0
             return pert_X
@@ -12,11 +12,12 @@ import tensorflow as tf
 import keras
 from keras.models import model_from_json
 import numpy as np
-from joblib import Parallel, delayed
+from joblib import Parallel
 from tqdm import tqdm
 from mkdir_p import mkdir_p
 
-from ..base import AttackModel
+from ..base import AttackModel, PerturbationSet
+from ...budget import get_n_jobs, budgeted_delayed
 from .attackbox import OPT_attack_lf
 from ...models.faiss_model import FaissLSHModel
 
@@ -250,25 +251,21 @@ class BlackBoxAttack(AttackModel):
             def predict_fn(x):
                 return self.model.predict(np.reshape(x, [len(x)] + list(ori_shape[1:])))
 
+        n_jobs = get_n_jobs(15)
         if self.ord == np.inf:
             attacker = OPT_attack_lf()
-            ret = Parallel(n_jobs=15, verbose=10)(delayed(attacker)(
+            ret = Parallel(n_jobs=n_jobs, verbose=10)(budgeted_delayed(attacker, n_jobs)(
                 predict_fn, xi, yi, TARGETED=False) for (xi, yi) in dataset)
         else:
-            ret = Parallel(n_jobs=15, verbose=10)(delayed(attack_untargeted)(
+            ret = Parallel(n_jobs=n_jobs, verbose=10)(budgeted_delayed(attack_untargeted, n_jobs)(
                 predict_fn, dataset, xi, yi, self.ord, alpha=self.alpha, beta=self.beta,
                 iterations=1000, ori_shape=ori_shape) for (xi, yi) in dataset)
 
         ret = (np.vstack(ret) - X).astype(np.float32)
         self.perts = ret
         if isinstance(eps, list):
-            rret = []
             norms = np.linalg.norm(ret, axis=1, ord=self.ord)
-            for ep in eps:
-                t = np.copy(ret)
-                t[norms > ep, :] = 0
-                rret.append(t.reshape(ori_shape))
-            return rret
+            return PerturbationSet(ret.reshape(ori_shape), eps, self.ord, norms=norms)
         elif eps is not None:
             ret[np.linalg.norm(ret, axis=1, ord=self.ord) > eps, :] = 0
             return ret.reshape(ori_shape)
@@ -0,0 +1,82 @@
+"""
+Half-space (bisector) constraints of the k-NN regions
+"""
+import numpy as np
+
+
+class HalfSpaceConstraints():
+    """Builds the constraints G z <= h for which z is at least as close to
+    every member of a tuple of training points as to the other points.
+
+    The bisector of a tuple member x_j and another point x_i is
+    (x_i - x_j) z <= (|x_i|^2 - |x_j|^2) / 2, so the squared norms of the
+    training data are computed once and each block of rows is a single
+    vectorized difference.
+
+    Arguments:
+        trnX {ndarray, shape=(n_samples, n_features)} -- Training data
+    """
+    def __init__(self, trnX):
+        self.trnX = np.ascontiguousarray(trnX, dtype=np.float64)
+        self.sqnorms = np.einsum('ij,ij->i', self.trnX, self.trnX)
+
+    def get_points(self, tuple_x, kdtree=None, faropp=-1):
+        """The competitors of every tuple member, all the other training
+        points if faropp == -1, otherwise the faropp nearest ones."""
+        tuple_x = np.asarray(tuple_x)
+        n = len(self.trnX)
+        mask = np.ones(n, dtype=bool)
+        mask[tuple_x] = False
+        if faropp == -1:
+            others = np.where(mask)[0]
+            return [others for _ in tuple_x]
+
+        near_points = kdtree.query(self.trnX[tuple_x], k=min(faropp, n),
+                                   return_distance=False)
+        return [p[mask[p]] for p in near_points]
+
+    def get_rows(self, j, points, G_out, h_out):
+        """Write the bisectors of tuple member j against points into G_out
+        and h_out."""
+        np.take(self.trnX, points, axis=0, out=G_out, mode='clip')
+        G_out -= self.trnX[j]
+        np.take(self.sqnorms, points, out=h_out, mode='clip')
+        h_out -= self.sqnorms[j]
+        h_out *= 0.5
+
+    def get_constraints(self, tuple_x, kdtree=None, faropp=-1, out=None):
+        """Constraints of the region defined by tuple_x.
+
+        Arguments:
+            tuple_x {ndarray} -- indices of the training points defining the region
+
+        Keyword Arguments:
+            kdtree {KDTree} -- tree over the training data, only used when faropp != -1 (default: {None})
+            faropp {int} -- number of nearest competitors per tuple member, -1 means all (default: {-1})
+            out {tuple} -- preallocated (G, h) buffers with at least as many rows as constraints (default: {None})
+
+        Returns:
+            G {ndarray, shape=(n_constraints, n_features)}
+            h {ndarray, shape=(n_constraints)}
+        """
+        points = self.get_points(tuple_x, kdtree, faropp)
+        n_rows = sum(len(p) for p in points)
+        if out is None:
+            G = np.empty((n_rows, self.trnX.shape[1]), dtype=np.float64)
+            h = np.empty(n_rows, dtype=np.float64)
+        else:
+            G, h = out[0][:n_rows], out[1][:n_rows]
+
+        start = 0
+        for j, p in zip(tuple_x, points):
+            self.get_rows(j, p, G[start:start+len(p)], h[start:start+len(p)])
+            start += len(p)
+        return G, h
+
+    def get_violations(self, z, tuple_x):
+        """G z - h of the bisectors between every tuple member and every
+        training point, shape=(len(tuple_x), n_samples)."""
+        proj = np.dot(self.trnX, z)
+        tuple_x = np.asarray(tuple_x)
+        return ((proj[np.newaxis, :] - proj[tuple_x, np.newaxis])
+                - (self.sqnorms[np.newaxis, :] - self.sqnorms[tuple_x, np.newaxis]) / 2)
@@ -12,11 +12,13 @@ import numpy as np
 from sklearn.neighbors import KDTree
 from sklearn.neighbors import KNeighborsClassifier
 import joblib
-from joblib import Parallel, delayed
+from joblib import Parallel
 from tqdm import tqdm
 
-from .cutils import c_get_half_space, get_all_half_spaces, get_constraints, check_feasibility
-from ..utils import solve_lp, solve_qp
+from .constraints import HalfSpaceConstraints
+from ..base import PerturbationSet
+from ..utils import solve_lp, solve_qp, as_shared_array
+from ...budget import get_n_jobs, budgeted_delayed
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -40,57 +42,22 @@ def get_half_space(a, b):
     c = sign * c
     return [w, c]
 
-#@profile
-def get_sol(target_x, tuple_x, faropp, kdtree,
-        glob_trnX, glob_trny, init_x=None, n_jobs=1):
-    tuple_x = np.asarray(tuple_x)
-    trnX = np.copy(glob_trnX)
-    emb_tar = target_x
-    G, h, _ = get_constraints(trnX, tuple_x, kdtree, faropp, emb_tar)
-    G, h = matrix(G, tc='d'), matrix(h, tc='d')
-
-    #assert (transformer.shape[1] == glob_trnX.shape[1])
+def _solve_l2(target_x, G, h, init_x=None, n_jobs=1):
     n_fets = target_x.shape[0]
+    Q = 2 * np.eye(n_fets)
+    q = (-2 * target_x).reshape((-1, 1))
 
-    Q = 2 * matrix(np.eye(n_fets), tc='d')
-    #T = matrix(transformer.astype(np.float64), tc='d')
+    temph = (h - CONSTRAINTTOL).reshape((-1, 1)) # make sure all constraints are met
 
-    #G = G * T
-    q = matrix(-2*target_x, tc='d')
-
-    temph = h - CONSTRAINTTOL # make sure all constraints are met
-
-    status, sol = solve_qp(np.array(Q), np.array(q), np.array(G),
-                           np.array(temph), n_fets)
+    status, sol = solve_qp(Q, q, G, temph, n_fets)
     if status == 'optimal':
         ret = sol.reshape(-1)
         return True, ret
     else:
         return False, None
 
-def sol_sat_constraints(G, h) -> bool:
-    """ Check if the constraint is satisfiable
-    """
-    fet_dim = G.shape[1]
-    c = matrix(np.zeros(fet_dim), tc='d')
-    G = matrix(G, tc='d')
-    temph = matrix(h - CONSTRAINTTOL, tc='d')
-    sol = solvers.lp(c=c, G=G, h=temph, solver='glpk')
-    return (sol['status'] == 'optimal')
-
-def get_sol_l1(target_x, tuple_x, faropp, kdtree, glob_trnX,
-        glob_trny, init_x=None):
-    tuple_x = np.asarray(tuple_x)
+def _solve_l1(target_x, G, h, init_x=None, n_jobs=1):
     fet_dim = target_x.shape[0]
-
-    emb_tar = target_x
-    trnX = np.copy(glob_trnX)
-    G, h, dist = get_constraints(trnX, tuple_x, kdtree, faropp, emb_tar)
-    #G = np.dot(G, transformer)
-
-    if init_x is None and not sol_sat_constraints(G, h):
-        return False, None
-
     c = matrix(np.concatenate((np.zeros(fet_dim), np.ones(fet_dim))), tc='d')
 
     G = np.hstack((G, np.zeros((G.shape[0], fet_dim))))
@@ -115,20 +82,8 @@ def get_sol_l1(target_x, tuple_x, faropp, kdtree, glob_trnX,
         #logger.warning("solver error")
         return False, None
 
-#@profile
-def get_sol_linf(target_x, tuple_x, faropp, kdtree,
-        glob_trnX, glob_trny, init_x=None, n_jobs=1):
-    tuple_x = np.asarray(tuple_x)
+def _solve_linf(target_x, G, h, init_x=None, n_jobs=1):
     fet_dim = target_x.shape[0]
-
-    emb_tar = target_x
-    trnX = np.copy(glob_trnX)
-    G, h, _ = get_constraints(trnX, tuple_x, kdtree, faropp, emb_tar)
-    #G = np.dot(G, transformer)
-
-    if init_x is None and not sol_sat_constraints(G, h):
-        return False, None
-
     c = np.concatenate((np.zeros(fet_dim), np.ones(1))).reshape((-1, 1))
 
     G2 = np.hstack((np.eye(fet_dim), -np.ones((fet_dim, 1))))
@@ -146,18 +101,137 @@ def get_sol_linf(target_x, tuple_x, faropp, kdtree,
     else:
         return False, None
 
+def cutting_plane_solve(solve_fn, target_x, tuple_x, kdtree, half_spaces,
+        n_init_cons, faropp=-1, init_x=None, n_jobs=1):
+    """Solve the region problem by lazily generating the bisector constraints.
+
+    Starts from the constraints against the `n_init_cons` nearest competitors
+    of every tuple member and repeatedly adds the constraints violated by the
+    current solution, at most `n_init_cons` per tuple member and round. When
+    no constraint is violated the solution is the one of the full problem,
+    the problem against the `faropp` nearest competitors if faropp != -1.
+    """
+    n_fets = half_spaces.trnX.shape[1]
+    if faropp != -1:
+        # the nearest n_init_cons are among the nearest faropp
+        n_init_cons = min(n_init_cons, faropp)
+    G, h = half_spaces.get_constraints(tuple_x, kdtree, n_init_cons)
+    # added[k, i] is True if the bisector of tuple_x[k] and i is in G or
+    # is not a constraint of the problem
+    added = np.zeros((len(tuple_x), len(half_spaces.trnX)), dtype=bool)
+    if faropp != -1:
+        added[:] = True
+        for k, p in enumerate(half_spaces.get_points(tuple_x, kdtree, faropp)):
+            added[k, p] = False
+    added[:, tuple_x] = True
+    for k, p in enumerate(half_spaces.get_points(tuple_x, kdtree, n_init_cons)):
+        added[k, p] = True
+
+    while True:
+        ret, sol = solve_fn(target_x, G, h, init_x=init_x, n_jobs=n_jobs)
+        if not ret:
+            return False, None
+
+        # G z <= h - CONSTRAINTTOL for the constraints not in G yet
+        viol = half_spaces.get_violations(sol, tuple_x) + CONSTRAINTTOL
+        viol[added] = -np.inf
+        points = []
+        for k in range(len(tuple_x)):
+            p = np.where(viol[k] > 0)[0]
+            if len(p) > n_init_cons:
+                p = p[np.argsort(-viol[k, p])[:n_init_cons]]
+            added[k, p] = True
+            points.append(p)
+
+        n_new = sum(len(p) for p in points)
+        if n_new == 0:
+            return True, sol
+        newG = np.empty((len(G) + n_new, n_fets), dtype=np.float64)
+        newh = np.empty(len(h) + n_new, dtype=np.float64)
+        newG[:len(G)], newh[:len(h)] = G, h
+        start = len(G)
+        for j, p in zip(tuple_x, points):
+            half_spaces.get_rows(j, p, newG[start:start+len(p)],
+                                 newh[start:start+len(p)])
+            start += len(p)
+        G, h = newG, newh
+
+#@profile
+def get_sol(target_x, tuple_x, faropp, kdtree,
+        glob_trnX, glob_trny, init_x=None, n_jobs=1, n_init_cons=-1,
+        half_spaces=None):
+    tuple_x = np.asarray(tuple_x)
+    if half_spaces is None:
+        half_spaces = HalfSpaceConstraints(glob_trnX)
+    if n_init_cons != -1:
+        return cutting_plane_solve(_solve_l2, target_x, tuple_x, kdtree,
+                                   half_spaces, n_init_cons, faropp=faropp,
+                                   n_jobs=n_jobs)
+
+    G, h = half_spaces.get_constraints(tuple_x, kdtree, faropp)
+    return _solve_l2(target_x, G, h, n_jobs=n_jobs)
+
+def sol_sat_constraints(G, h) -> bool:
+    """ Check if the constraint is satisfiable
+    """
+    fet_dim = G.shape[1]
+    c = matrix(np.zeros(fet_dim), tc='d')
+    G = matrix(G, tc='d')
+    temph = matrix(h - CONSTRAINTTOL, tc='d')
+    sol = solvers.lp(c=c, G=G, h=temph, solver='glpk')
+    return (sol['status'] == 'optimal')
+
+def get_sol_l1(target_x, tuple_x, faropp, kdtree, glob_trnX,
+        glob_trny, init_x=None, n_jobs=1, n_init_cons=-1, half_spaces=None):
+    tuple_x = np.asarray(tuple_x)
+
+    if half_spaces is None:
+        half_spaces = HalfSpaceConstraints(glob_trnX)
+    if n_init_cons != -1:
+        # no feasibility check needed, an infeasible relaxation already
+        # means an infeasible region
+        return cutting_plane_solve(_solve_l1, target_x, tuple_x, kdtree,
+                                   half_spaces, n_init_cons, faropp=faropp,
+                                   init_x=init_x, n_jobs=n_jobs)
+
+    G, h = half_spaces.get_constraints(tuple_x, kdtree, faropp)
+    #G = np.dot(G, transformer)
+
+    if init_x is None and not sol_sat_constraints(G, h):
+        return False, None
+
+    return _solve_l1(target_x, G, h, init_x=init_x)
+
+#@profile
+def get_sol_linf(target_x, tuple_x, faropp, kdtree,
+        glob_trnX, glob_trny, init_x=None, n_jobs=1, n_init_cons=-1,
+        half_spaces=None):
+    tuple_x = np.asarray(tuple_x)
+
+    if half_spaces is None:
+        half_spaces = HalfSpaceConstraints(glob_trnX)
+    if n_init_cons != -1:
+        return cutting_plane_solve(_solve_linf, target_x, tuple_x, kdtree,
+                                   half_spaces, n_init_cons, faropp=faropp,
+                                   n_jobs=n_jobs)
+
+    G, h = half_spaces.get_constraints(tuple_x, kdtree, faropp)
+    #G = np.dot(G, transformer)
+
+    if init_x is None and not sol_sat_constraints(G, h):
+        return False, None
+
+    return _solve_linf(target_x, G, h, n_jobs=n_jobs)
+
 def get_adv(target_x, target_y, kdtree, n_searches, n_neighbors, faropp,
-        lp_sols, glob_trnX, glob_trny, ord=2, n_jobs=1):
+        lp_sols, glob_trnX, glob_trny, ord=2, n_jobs=1, n_init_cons=-1,
+        half_spaces=None):
     ind = kdtree.query(target_x.reshape((1, -1)),
                        k=n_neighbors, return_distance=False)[0]
     if target_y != np.argmax(np.bincount(glob_trny[ind])):
         # already incorrectly predicted
         return np.zeros_like(target_x)
 
-    knn = KNeighborsClassifier(n_neighbors=n_neighbors)
-    knn.fit(glob_trnX, glob_trny)
-    pred_trny = knn.predict(glob_trnX)
-
     temp = (target_x, np.inf)
     if n_searches == -1:
         n_searches = glob_trnX.shape[0]
@@ -186,17 +260,20 @@ def get_adv(target_x, target_y, kdtree, n_searches, n_neighbors, faropp,
     def _helper(comb, trnX, trny, init_x):
         comb_tup = tuple(ind[comb])
         ret, sol = get_sol_fn(target_x, ind[comb], faropp, kdtree,
-                              trnX, trny, init_x=init_x, n_jobs=n_jobs)
+                              trnX, trny, init_x=init_x, n_jobs=n_jobs,
+                              n_init_cons=n_init_cons, half_spaces=half_spaces)
         return ret, sol
     not_vacum = lambda x: tuple(ind[x]) not in lp_sols or lp_sols[tuple(ind[x])]
     combs = list(filter(not_vacum, combs))
+    n_workers = get_n_jobs(-1)
     if n_neighbors == 1:
-        sols = Parallel(n_jobs=-1, verbose=1)(
-                delayed(_helper)(comb, glob_trnX, glob_trny,
+        sols = Parallel(n_jobs=n_workers, verbose=1)(
+                budgeted_delayed(_helper, n_workers)(comb, glob_trnX, glob_trny,
                     init_x=glob_trnX[ind[comb[0]]]) for comb in combs)
     else:
-        sols = Parallel(n_jobs=-1, verbose=1)(
-                delayed(_helper)(comb, glob_trnX, glob_trny, None) for comb in combs)
+        sols = Parallel(n_jobs=n_workers, verbose=1)(
+                budgeted_delayed(_helper, n_workers)(comb, glob_trnX, glob_trny, None)
+                for comb in combs)
     status, sols = zip(*sols)
     sols = np.array(sols)
     for i, s in enumerate(status):
@@ -218,13 +295,7 @@ def get_adv(target_x, target_y, kdtree, n_searches, n_neighbors, faropp,
 def attack_with_eps_constraint(perts, ord, eps):
     perts = np.asarray(perts)
     if isinstance(eps, list):
-        rret = []
-        norms = np.linalg.norm(perts, axis=1, ord=ord)
-        for ep in eps:
-            t = np.copy(perts)
-            t[norms > ep, :] = 0
-            rret.append(t)
-        return rret
+        return PerturbationSet(perts, eps, ord)
     elif eps is not None:
         perts[np.linalg.norm(perts, axis=1, ord=ord) > eps, :] = 0
         return perts
@@ -233,7 +304,8 @@ def attack_with_eps_constraint(perts, ord, eps):
 
 def rev_get_adv(target_x, target_y, kdtree, n_searches, n_neighbors, faropp,
         lp_sols, glob_trnX, glob_trny, ord=2, method='self',
-        knn: KNeighborsClassifier = None, n_jobs=1):
+        knn: KNeighborsClassifier = None, n_jobs=1, n_init_cons=-1,
+        half_spaces=None):
     if n_searches == -1:
         n_searches = glob_trnX.shape[0]
     temp = (target_x, np.inf)
@@ -251,8 +323,6 @@ def rev_get_adv(target_x, target_y, kdtree, n_searches, n_neighbors, faropp,
     else:
         raise ValueError("Unsupported ord %d" % ord)
 
-    knn = KNeighborsClassifier(n_neighbors=n_neighbors)
-    knn.fit(glob_trnX, glob_trny)
     pred_trny = knn.predict(glob_trnX)
 
     ind = kdtree.query(target_x.reshape((1, -1)),
@@ -269,7 +339,8 @@ def rev_get_adv(target_x, target_y, kdtree, n_searches, n_neighbors, faropp,
         inds = tuple([_ for _ in inds])
 
         ret, sol = get_sol_fn(target_x, inds, faropp, kdtree,
-                glob_trnX, glob_trny, init_x=glob_trnX[i], n_jobs=n_jobs)
+                glob_trnX, glob_trny, init_x=glob_trnX[i], n_jobs=n_jobs,
+                n_init_cons=n_init_cons, half_spaces=half_spaces)
         solsss.append(sol)
 
         if method == 'region':
@@ -295,11 +366,13 @@ def rev_get_adv(target_x, target_y, kdtree, n_searches, n_neighbors, faropp,
 
 class NNOptAttack():
     def __init__(self, trnX, trny, n_neighbors=3, n_searches=-1, faropp=-1,
-            transformer=None, ord=2, n_jobs=1):
+            transformer=None, ord=2, n_jobs=1, n_init_cons=-1):
         #furthest >= K
         self.n_jobs = n_jobs
+        self.n_init_cons = n_init_cons
         self.K = n_neighbors
-        self.trnX = trnX
+        # shared read-only by every solve, never copied
+        self.trnX = as_shared_array(trnX)
         self.trny = trny
         self.n_searches = min(n_searches, len(trnX))
         self.faropp = faropp
@@ -309,6 +382,7 @@ class NNOptAttack():
             self.tree = KDTree(self.transformer.transform(self.trnX))
         else:
             self.tree = KDTree(self.trnX)
+        self.half_spaces = HalfSpaceConstraints(self.trnX)
         self.lp_sols = {}
 
     def perturb(self, X, y, eps=None, logging=False, n_jobs=1):
@@ -317,10 +391,10 @@ class NNOptAttack():
 
 class NNAttack(NNOptAttack):
     def __init__(self, trnX, trny, n_neighbors=3, n_searches=-1, faropp=-1,
-            transformer=None, ord=2, n_jobs=1):
+            transformer=None, ord=2, n_jobs=1, n_init_cons=-1):
         super().__init__(trnX=trnX, trny=trny, n_neighbors=n_neighbors,
                 n_searches=n_searches, faropp=faropp, transformer=transformer,
-                ord=ord, n_jobs=n_jobs)
+                ord=ord, n_jobs=n_jobs, n_init_cons=n_init_cons)
 
     #@profile
     def perturb(self, X, y, eps=None, n_jobs=1):
@@ -341,7 +415,9 @@ class NNAttack(NNOptAttack):
                                self.lp_sols,
                                glob_trnX=glob_trnX,
                                glob_trny=glob_trny,
-                               ord=self.ord))
+                               ord=self.ord,
+                               n_init_cons=self.n_init_cons,
+                               half_spaces=self.half_spaces))
 
         self.perts = np.asarray(ret)
         return attack_with_eps_constraint(self.perts, self.ord, eps)
@@ -359,10 +435,13 @@ class KNNRegionBasedAttackExact(NNAttack):
         n_searches {int} -- Number of regions to search, -1 means all regions (default: {-1})
         ord {int} -- Order of the norm for perturbation distance, see numpy.linalg.norm for more information (default: {2})
         n_jobs {int} -- number of cores to run (default: {1})
+        n_init_cons {int} -- Number of nearest competitors per region member used to start the cutting-plane solve, -1 means building all constraints up front (default: {20})
     """
-    def __init__(self, trnX, trny, n_neighbors=3, n_searches=-1, ord=2, n_jobs=1):
+    def __init__(self, trnX, trny, n_neighbors=3, n_searches=-1, ord=2, n_jobs=1,
+                 n_init_cons=20):
         super().__init__(trnX=trnX, trny=trny, n_neighbors=n_neighbors,
-                n_searches=-1, faropp=-1, transformer=None, ord=ord, n_jobs=n_jobs)
+                n_searches=-1, faropp=-1, transformer=None, ord=ord, n_jobs=n_jobs,
+                n_init_cons=n_init_cons)
 
 class RevNNAttack(NNOptAttack):
     """
@@ -380,13 +459,14 @@ class RevNNAttack(NNOptAttack):
         faropp {int} -- Not used (default: {-1})
         transformer {[type]} -- Not used (default: {None})
         method {str} -- Not used (default: {'region'})
+        n_init_cons {int} -- Number of nearest competitors per region member used to start the cutting-plane solve, -1 means building all constraints up front (default: {-1})
     """
     def __init__(self, trnX: np.array, trny: np.array, n_neighbors: int = 3,
                  n_searches: int = -1, faropp: int = -1, transformer=None, ord=2,
-                 method='region', n_jobs=1):
+                 method='region', n_jobs=1, n_init_cons=-1):
         super().__init__(trnX=trnX, trny=trny, n_neighbors=n_neighbors,
                 n_searches=n_searches, faropp=faropp, transformer=transformer,
-                ord=ord)
+                ord=ord, n_init_cons=n_init_cons)
         self.method = method
 
     #@profile
@@ -405,7 +485,7 @@ class RevNNAttack(NNOptAttack):
         knn.fit(glob_trnX, glob_trny)
         X = X.astype(np.float64)
 
-        n_jobs = -1
+        n_jobs = get_n_jobs(-1)
         if n_jobs == 1:
             ret = []
             for i, (target_x, target_y) in tqdm(enumerate(zip(X, y)), ascii=True, desc="Perturb"):
@@ -415,6 +495,8 @@ class RevNNAttack(NNOptAttack):
                         self.lp_sols, ord=self.ord,
                         method=self.method, knn=knn, n_jobs=self.n_jobs,
                         glob_trnX=glob_trnX, glob_trny=glob_trny,
+                        n_init_cons=self.n_init_cons,
+                        half_spaces=self.half_spaces,
                     )
                 )
         else:
@@ -425,9 +507,11 @@ class RevNNAttack(NNOptAttack):
                     dict(), ord=self.ord,
                     method=self.method, knn=knn, n_jobs=1,
                     glob_trnX=glob_trnX, glob_trny=glob_trny,
+                    n_init_cons=self.n_init_cons,
+                    half_spaces=self.half_spaces,
                 )
             ret = Parallel(n_jobs=n_jobs, verbose=1)(
-                    delayed(_helper)(tar_x, tar_y)
+                    budgeted_delayed(_helper, n_jobs)(tar_x, tar_y)
                         for (tar_x, tar_y) in zip(X, y))
 
         self.perts = np.asarray(ret)
@@ -446,9 +530,10 @@ class KNNRegionBasedAttackApprox(RevNNAttack):
         n_searches {int} -- Number of regions to search, -1 means all regions (default: {-1})
         ord {int} -- Order of the norm for perturbation distance, see numpy.linalg.norm for more information (default: {2})
         n_jobs {int} -- number of cores to run (default: {1})
+        n_init_cons {int} -- Number of nearest competitors per region member used to start the cutting-plane solve, -1 means building all constraints up front (default: {20})
     """
     def __init__(self, trnX: np.array, trny: np.array, n_neighbors: int = 3,
-                 n_searches: int = -1, ord=2, n_jobs=1):
+                 n_searches: int = -1, ord=2, n_jobs=1, n_init_cons=20):
         super().__init__(trnX=trnX, trny=trny, n_neighbors=n_neighbors,
                 n_searches=n_searches, faropp=-1, transformer=None, ord=ord,
-                method='region', n_jobs=n_jobs)
+                method='region', n_jobs=n_jobs, n_init_cons=n_init_cons)
@@ -0,0 +1,53 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from nnattack.attacks.base import AttackModel, PerturbationSet
+
+
+class TestPerturbationSet(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.perts = random_state.randn(50, 3)
+        self.eps_list = [0.1 * i for i in range(21)]
+
+    def masked_copies(self, ord):
+        # the list of copies the attacks used to return
+        norms = np.linalg.norm(self.perts, axis=1, ord=ord)
+        rret = []
+        for ep in self.eps_list:
+            t = np.copy(self.perts)
+            t[norms > ep, :] = 0
+            rret.append(t)
+        return rret
+
+    def test_same_as_copies(self):
+        for ord in [1, 2, np.inf]:
+            old = self.masked_copies(ord)
+            perturbs = AttackModel(ord=ord)._pert_with_eps_constraint(
+                    np.copy(self.perts), self.eps_list)
+            self.assertIsInstance(perturbs, PerturbationSet)
+
+            self.assertEqual(len(old), len(perturbs))
+            self.assertEqual(np.shape(old), perturbs.shape)
+            assert_array_equal(np.array(old), np.asarray(perturbs))
+            assert_array_equal(np.array(old, dtype=np.float32),
+                               np.asarray(perturbs, dtype=np.float32))
+            for i in [0, 5, -1]:
+                assert_array_equal(old[i], perturbs[i])
+            for a, b in zip(old, perturbs):
+                assert_array_equal(a, b)
+
+            for s in [slice(2, 7), slice(None, None, 3), slice(-4, None)]:
+                sub = perturbs[s]
+                self.assertIsInstance(sub, PerturbationSet)
+                self.assertEqual(self.eps_list[s], sub.eps_list)
+                assert_array_equal(np.array(old[s]), np.asarray(sub))
+
+    def test_empty(self):
+        perturbs = PerturbationSet(self.perts, [], 2)
+        self.assertEqual((0, 50, 3), np.asarray(perturbs).shape)
+
+if __name__ == '__main__':
+    unittest.main()
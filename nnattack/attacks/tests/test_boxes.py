@@ -0,0 +1,49 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_almost_equal, assert_array_equal
+
+from sklearn.tree import DecisionTreeClassifier
+
+from nnattack.attacks.trees.boxes import get_leaf_boxes, nearest_box_points
+
+
+class TestBoxes(unittest.TestCase):
+    def setUp(self):
+        # [upper, -lower], the second box is empty
+        self.regions = np.array([
+            [2, 1, -1, 0],
+            [0, 0, -1, -1],
+            [np.inf, np.inf, -3, -3],
+        ], dtype=np.float64)
+
+    def test_nearest(self):
+        X = np.array([[0, 0], [2.5, 4]], dtype=np.float64)
+        for ord in [1, 2, np.inf]:
+            points, region_ids = nearest_box_points(X, self.regions, ord, tol=0)
+            assert_array_equal([0, 2], region_ids)
+            assert_almost_equal([1, 0.5], np.linalg.norm(points - X, ord=ord, axis=1))
+
+    def test_mask(self):
+        X = np.array([[0, 0], [2.5, 4]], dtype=np.float64)
+        points, region_ids = nearest_box_points(
+                X, self.regions, 2, mask=[[False, True, True], [False, True, False]])
+        assert_array_equal([2, -1], region_ids)
+        assert_array_equal(X[1], points[1])
+        self.assertTrue(np.all(points[0] > 3))
+
+    def test_leaf_boxes(self):
+        random_state = np.random.RandomState(0)
+        X = random_state.rand(200, 3).astype(np.float32)
+        y = random_state.randint(3, size=200)
+        clf = DecisionTreeClassifier(max_depth=5, random_state=0).fit(X, y)
+
+        leaves, boxes, preds = get_leaf_boxes(clf)
+        idx = np.searchsorted(leaves, clf.apply(X))
+        assert_array_equal(leaves[idx], clf.apply(X))
+        self.assertTrue(np.all(X > boxes[idx, 0]))
+        self.assertTrue(np.all(X <= boxes[idx, 1]))
+        assert_array_equal(clf.predict(X), clf.classes_[preds[idx]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_almost_equal
+
+from sklearn.neighbors import KDTree
+
+from nnattack.attacks.nns.nn_attack import get_sol, get_sol_l1, get_sol_linf
+
+
+class TestCuttingPlane(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.trnX = random_state.rand(200, 3)
+        self.trny = random_state.randint(2, size=200)
+        self.kdtree = KDTree(self.trnX)
+        self.targets = random_state.rand(20, 3)
+        # the 2 nearest neighbors of a point, their region is not empty
+        self.tuples = self.kdtree.query(random_state.rand(20, 3), k=2,
+                                        return_distance=False)
+
+    def test_same_as_full_solve(self):
+        # the l1 and linf solutions may not be unique, their distances are
+        for get_sol_fn, ord in [(get_sol, 2), (get_sol_l1, 1), (get_sol_linf, np.inf)]:
+            for faropp in [-1, 8]:
+                n_feasible = 0
+                for target_x, tuple_x in zip(self.targets, self.tuples):
+                    full = get_sol_fn(target_x, tuple_x, faropp, self.kdtree,
+                                      self.trnX, self.trny)
+                    cut = get_sol_fn(target_x, tuple_x, faropp, self.kdtree,
+                                     self.trnX, self.trny, n_init_cons=3)
+                    self.assertEqual(full[0], cut[0])
+                    if full[0]:
+                        n_feasible += 1
+                        assert_almost_equal(np.linalg.norm(full[1] - target_x, ord=ord),
+                                            np.linalg.norm(cut[1] - target_x, ord=ord),
+                                            decimal=4)
+                        if ord == 2:
+                            assert_almost_equal(full[1], cut[1], decimal=4)
+                self.assertGreater(n_feasible, 0)
+
+if __name__ == '__main__':
+    unittest.main()
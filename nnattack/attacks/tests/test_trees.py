@@ -0,0 +1,59 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_almost_equal, assert_array_equal
+
+from sklearn.tree import DecisionTreeClassifier
+from sklearn.ensemble import RandomForestClassifier
+
+from nnattack.attacks.trees.dt_opt import DTOpt
+from nnattack.attacks.trees.rf_attack import RFAttack
+
+
+class TestDTOpt(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.X = random_state.rand(300, 4)
+        self.y = random_state.randint(3, size=300)
+        self.clf = DecisionTreeClassifier(max_depth=6, random_state=0).fit(self.X, self.y)
+
+    def test_nearest_leaf(self):
+        # branch and bound against the distance to every leaf
+        for ord in [1, 2, np.inf]:
+            attack = DTOpt(self.clf, ord=ord, random_state=0)
+            pred_y = self.clf.predict(self.X)
+            for x, target_y in zip(self.X[:50], pred_y[:50]):
+                target = np.where(self.clf.classes_ == target_y)[0][0]
+                has_other = np.delete(attack.subtree_classes, target, axis=1).any(axis=1)
+                other = np.where(attack.leaf_preds != target)[0]
+                dists = np.linalg.norm(
+                        np.clip(x, attack.leaf_lower[other], attack.leaf_upper[other]) - x,
+                        ord=ord, axis=1)
+
+                i = attack._nearest_leaf(x, has_other)
+                self.assertNotEqual(target, attack.leaf_preds[i])
+                assert_almost_equal(dists.min(), np.linalg.norm(
+                    np.clip(x, attack.leaf_lower[i], attack.leaf_upper[i]) - x, ord=ord))
+
+class TestForestMILP(unittest.TestCase):
+    def test_milp(self):
+        # the MILP against the enumeration of every region of the forest
+        random_state = np.random.RandomState(0)
+        X = random_state.rand(60, 2).astype(np.float32)
+        y = (X[:, 0] + X[:, 1] > 1).astype(int)
+        y[random_state.rand(60) < 0.2] ^= 1
+        clf = RandomForestClassifier(n_estimators=3, max_depth=3,
+                                     random_state=0).fit(X, y)
+        tstX, tsty = X[:20], clf.predict(X[:20])
+
+        for ord in [1, np.inf]:
+            perts = []
+            for method in ['all', 'milp']:
+                attack = RFAttack(X, y, clf, ord=ord, method=method)
+                attack.perturb(tstX, tsty, eps=1.)
+                assert_array_equal(tsty != clf.predict(tstX + attack.perts), True)
+                perts.append(np.linalg.norm(attack.perts, ord=ord, axis=1))
+            assert_almost_equal(perts[0], perts[1], decimal=4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+Closed-form projections onto the axis-aligned boxes of tree regions
+
+A region is stored as a vector r of length 2 * n_features, r[:n_features]
+are the upper bounds (x <= r[i]) and -r[n_features:] are the strict lower
+bounds (x > -r[i + n_features]).  The nearest point of a box is the target
+clipped into it, for the l1, l2 and linf norms alike.
+"""
+import numpy as np
+
+BOX_TOL = 1e-6
+# number of float64 entries of the (n_samples, n_regions, n_features) gap
+# array computed at once
+MAX_BATCH_ELEMENTS = 2**24
+
+
+def regions_to_bounds(regions):
+    """Split regions of shape (n_regions, 2 * n_features) into their
+    (lower, upper) bounds."""
+    regions = np.asarray(regions, dtype=np.float64)
+    n_dims = regions.shape[1] // 2
+    return -regions[:, n_dims:], regions[:, :n_dims]
+
+def bounds_to_regions(lower, upper):
+    """Stack (lower, upper) bounds into the [upper, -lower] region format."""
+    return np.hstack((upper, -lower))
+
+def get_leaf_boxes(clf):
+    """Box of every leaf of a fitted sklearn decision tree, computed level by
+    level from the node arrays and cached on the estimator.
+
+    Arguments:
+        clf {DecisionTreeClassifier} -- fitted decision tree
+
+    Returns:
+        leaves {ndarray, shape=(n_leaves)} -- node ids of the leaves, ascending
+        boxes {ndarray, shape=(n_leaves, 2, n_features)} -- lower (strict) and upper bounds of each leaf
+        preds {ndarray, shape=(n_leaves)} -- index in clf.classes_ of the class predicted by each leaf
+    """
+    tree = clf.tree_
+    cached = getattr(clf, '_leaf_boxes', None)
+    if cached is not None and cached[0] is tree:
+        return cached[1]
+
+    children_left = tree.children_left
+    children_right = tree.children_right
+    feature = tree.feature
+    threshold = tree.threshold
+    n_dims = tree.n_features
+
+    nodes = np.zeros(1, dtype=np.intp)
+    lower = np.full((1, n_dims), -np.inf)
+    upper = np.full((1, n_dims), np.inf)
+    leaves, leaf_lower, leaf_upper = [], [], []
+    while len(nodes) > 0:
+        is_leaf = (children_left[nodes] == children_right[nodes])
+        leaves.append(nodes[is_leaf])
+        leaf_lower.append(lower[is_leaf])
+        leaf_upper.append(upper[is_leaf])
+
+        nodes, lower, upper = nodes[~is_leaf], lower[~is_leaf], upper[~is_leaf]
+        rows, fets, thres = np.arange(len(nodes)), feature[nodes], threshold[nodes]
+        # left child x <= threshold, right child x > threshold
+        left_upper = np.copy(upper)
+        left_upper[rows, fets] = np.minimum(left_upper[rows, fets], thres)
+        right_lower = np.copy(lower)
+        right_lower[rows, fets] = np.maximum(right_lower[rows, fets], thres)
+
+        nodes = np.concatenate((children_left[nodes], children_right[nodes]))
+        lower = np.vstack((lower, right_lower))
+        upper = np.vstack((left_upper, upper))
+
+    leaves = np.concatenate(leaves)
+    order = np.argsort(leaves)
+    leaves = leaves[order]
+    boxes = np.stack((np.vstack(leaf_lower)[order], np.vstack(leaf_upper)[order]), axis=1)
+    preds = np.argmax(tree.value[leaves, 0], axis=1)
+
+    clf._leaf_boxes = (tree, (leaves, boxes, preds))
+    return leaves, boxes, preds
+
+def empty_regions(regions):
+    """Regions with a lower bound above their upper bound."""
+    lower, upper = regions_to_bounds(regions)
+    return np.any(lower > upper, axis=1)
+
+def shrink_bounds(lower, upper, tol=BOX_TOL):
+    """Move the finite bounds inside the box by tol (relative to their
+    magnitude) so a clipped point is strictly inside after the float32
+    conversion sklearn does, boxes narrower than that collapse to their
+    midpoint."""
+    lower = np.asarray(lower, dtype=np.float64)
+    upper = np.asarray(upper, dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        lo = np.where(np.isfinite(lower),
+                      lower + tol * np.maximum(1., np.abs(lower)), lower)
+        hi = np.where(np.isfinite(upper),
+                      upper - tol * np.maximum(1., np.abs(upper)), upper)
+        narrow = lo > hi
+        mid = (lower + upper) / 2
+    return np.where(narrow, mid, lo), np.where(narrow, mid, hi)
+
+def nearest_box_points(X, regions, ord, mask=None, tol=BOX_TOL):
+    """Nearest point of the closest allowed region for every sample.
+
+    Arguments:
+        X {ndarray, shape=(n_samples, n_features)} -- Target samples
+        regions {ndarray, shape=(n_regions, 2*n_features)} -- Boxes in the [upper, -lower] format
+        ord {int} -- Order of the norm, 1, 2 or np.inf
+
+    Keyword Arguments:
+        mask {ndarray, shape=(n_regions) or (n_samples, n_regions)} -- Regions allowed for each sample, all if None (default: {None})
+        tol {float} -- Margin kept from the region boundaries (default: {BOX_TOL})
+
+    Returns:
+        points {ndarray, shape=(n_samples, n_features)} -- Nearest points, the sample itself if no region is allowed
+        region_ids {ndarray, shape=(n_samples)} -- Index of the nearest region, -1 if no region is allowed
+    """
+    if ord not in [1, 2, np.inf]:
+        raise ValueError("ord %s not supported" % str(ord))
+
+    X = np.asarray(X, dtype=np.float64)
+    points = np.copy(X)
+    region_ids = -np.ones(len(X), dtype=int)
+    regions = np.asarray(regions, dtype=np.float64)
+    if len(X) == 0 or len(regions) == 0:
+        return points, region_ids
+
+    lower, upper = regions_to_bounds(regions)
+    allowed = ~empty_regions(regions)
+    lo, hi = shrink_bounds(lower, upper, tol)
+    if mask is not None:
+        mask = np.broadcast_to(np.asarray(mask, dtype=bool),
+                               (len(X), len(regions)))
+
+    batch_size = max(1, MAX_BATCH_ELEMENTS // lo.size)
+    for start in range(0, len(X), batch_size):
+        x = X[start:start+batch_size]
+        # distance of every coordinate to the box, zero inside
+        gap = (np.maximum(lo[np.newaxis] - x[:, np.newaxis], 0)
+               + np.maximum(x[:, np.newaxis] - hi[np.newaxis], 0))
+        if ord == np.inf:
+            dist = gap.max(axis=2)
+        elif ord == 2:
+            dist = np.einsum('ijk,ijk->ij', gap, gap)
+        else:
+            dist = gap.sum(axis=2)
+
+        dist[:, ~allowed] = np.inf
+        if mask is not None:
+            dist[~mask[start:start+batch_size]] = np.inf
+
+        idx = dist.argmin(axis=1)
+        found = np.isfinite(dist[np.arange(len(x)), idx])
+        idx = idx[found]
+        rows = np.arange(start, start+len(x))[found]
+        region_ids[rows] = idx
+        points[rows] = np.clip(X[rows], lo[idx], hi[idx])
+
+    return points, region_ids
@@ -0,0 +1,234 @@
+"""
+Exact attack on tree ensembles as a mixed integer linear program
+
+Kantchelian et al., Evasion and Hardening of Tree Ensemble Classifiers
+https://arxiv.org/abs/1509.07892
+"""
+import numpy as np
+import scipy.sparse as sp
+
+from .boxes import get_leaf_boxes, shrink_bounds
+
+# margin of the vote constraint, kept above the solver feasibility tolerance
+VOTE_TOL = 1e-5
+
+
+def _import_milp():
+    try:
+        from scipy.optimize import milp, LinearConstraint, Bounds
+    except ImportError:
+        raise ImportError("The MILP attack needs scipy.optimize.milp, "
+                          "available from scipy 1.9")
+    return milp, LinearConstraint, Bounds
+
+
+class ForestMILP():
+    """Minimal perturbation of a tree ensemble as a MILP.
+
+    The variables are [p, z] and t for linf: one binary p per distinct
+    (feature, threshold) predicate with p = 1 iff x[feature] <= threshold,
+    one binary z per leaf and the linf distance t. The distance is linear
+    in the predicates, so x is not a variable and no big-M constraint is
+    needed. The formulation grows linearly with the number of leaves.
+
+    Arguments:
+        estimators {list of DecisionTreeClassifier} -- Trees of the ensemble, predicting with the mean of their leaf probabilities
+        n_features {int} -- Number of features
+    """
+    def __init__(self, estimators, n_features):
+        self.n_features = n_features
+
+        inner_nodes, pred_features, pred_thresholds = [], [], []
+        for tree_clf in estimators:
+            tree = tree_clf.tree_
+            inner = np.where(tree.children_left != tree.children_right)[0]
+            inner_nodes.append(inner)
+            pred_features.append(tree.feature[inner])
+            pred_thresholds.append(tree.threshold[inner])
+        preds, pred_ids = np.unique(
+                np.stack((np.concatenate(pred_features).astype(np.float64),
+                          np.concatenate(pred_thresholds)), axis=1),
+                axis=0, return_inverse=True)
+        pred_ids = pred_ids.reshape(-1)
+        # sorted by feature, then by threshold
+        self.pred_features = preds[:, 0].astype(np.intp)
+        self.pred_thresholds = preds[:, 1]
+        self.n_preds = len(preds)
+
+        rows, cols, vals, b_ub = [], [], [], []
+        n_rows = 0
+        n_vars = self.n_preds
+        self.leaf_slices, self.leaf_boxes, leaf_probas = [], [], []
+        pred_start = 0
+        for tree_clf, inner in zip(estimators, inner_nodes):
+            tree = tree_clf.tree_
+            children_left = tree.children_left
+            children_right = tree.children_right
+            leaves, boxes, _ = get_leaf_boxes(tree_clf)
+            value = tree.value[leaves, 0]
+            self.leaf_slices.append(slice(n_vars, n_vars + len(leaves)))
+            self.leaf_boxes.append(boxes)
+            leaf_probas.append(value / value.sum(axis=1, keepdims=True))
+
+            node_pred = pred_ids[pred_start:pred_start+len(inner)]
+            pred_start += len(inner)
+            inner_idx = -np.ones(tree.node_count, dtype=np.intp)
+            inner_idx[inner] = np.arange(len(inner))
+            parents = -np.ones(tree.node_count, dtype=np.intp)
+            parents[children_left[inner]] = inner
+            parents[children_right[inner]] = inner
+
+            # sum of the leaves left of a node <= p, right of it <= 1 - p,
+            # one pair of rows per inner node
+            cur = np.copy(leaves)
+            leaf_cols = np.arange(n_vars, n_vars + len(leaves))
+            while len(cur) > 0:
+                parent = parents[cur]
+                has_parent = (parent != -1)
+                cur, parent, leaf_cols = cur[has_parent], parent[has_parent], \
+                        leaf_cols[has_parent]
+                is_right = (children_right[parent] == cur)
+                rows.append(n_rows + 2 * inner_idx[parent] + is_right)
+                cols.append(leaf_cols)
+                vals.append(np.ones(len(cur)))
+                cur = parent
+            rows.append(n_rows + np.arange(2 * len(inner)))
+            cols.append(np.repeat(node_pred, 2))
+            vals.append(np.tile([-1., 1.], len(inner)))
+            b_ub.append(np.tile([0., 1.], len(inner)))
+            n_rows += 2 * len(inner)
+            n_vars += len(leaves)
+
+        # p[f, k] <= p[f, k+1], the thresholds of a feature are sorted
+        same = np.where(self.pred_features[:-1] == self.pred_features[1:])[0]
+        rows.extend([n_rows + np.arange(len(same))] * 2)
+        cols.extend([same, same + 1])
+        vals.extend([np.ones(len(same)), -np.ones(len(same))])
+        b_ub.append(np.zeros(len(same)))
+        n_rows += len(same)
+
+        self.n_leaves = n_vars - self.n_preds
+        self.leaf_probas = np.vstack(leaf_probas)
+        self.tree_rows = (np.concatenate(rows), np.concatenate(cols),
+                          np.concatenate(vals), n_rows)
+        self.tree_b_ub = np.concatenate(b_ub)
+
+        # one leaf per tree
+        self.A_eq = sp.lil_matrix((len(estimators), n_vars))
+        for i, s in enumerate(self.leaf_slices):
+            self.A_eq[i, s] = 1
+        self.A_eq = self.A_eq.tocsr()
+
+    def _get_objective(self, target_x, ord):
+        """Distance to target_x as a linear function of the predicates.
+
+        With the thresholds of a feature sorted and target_x[f] between t[j]
+        and t[j+1], x[f] <= t[k] costs target_x[f] - t[k] for k <= j, which
+        telescopes into sum_{i=k}^{j} (t[i+1] - t[i]) p[i] since the
+        predicates are monotone, and symmetrically above target_x[f].
+
+        Returns:
+            weights {ndarray, shape=(n_preds)} -- cost of each predicate being 1 (below) or 0 (above)
+            below {ndarray, shape=(n_preds)} -- whether the threshold is below target_x
+        """
+        feat, thres = self.pred_features, self.pred_thresholds
+        x = target_x[feat]
+        below = thres < x
+        same_feat_next = np.append(feat[1:] == feat[:-1], False)
+        same_feat_prev = np.insert(feat[1:] == feat[:-1], 0, False)
+
+        if ord == np.inf:
+            return np.abs(x - thres), below
+
+        # next threshold below target_x, or target_x itself
+        nxt = np.append(thres[1:], np.inf)
+        nxt = np.where(np.logical_and(same_feat_next, np.append(below[1:], False)), nxt, x)
+        # previous threshold above target_x, or target_x itself
+        prv = np.insert(thres[:-1], 0, -np.inf)
+        prv = np.where(np.logical_and(same_feat_prev, ~np.insert(below[:-1], 0, True)), prv, x)
+        return np.where(below, nxt - thres, thres - prv), below
+
+    def perturb(self, target_x, target_class, ord, time_limit=None):
+        """Closest point predicted as another class than target_class.
+
+        Arguments:
+            target_x {ndarray, shape=(n_features)} -- Target sample
+            target_class {int} -- Index of the class of the sample
+            ord {int} -- Order of the norm, 1 or np.inf
+
+        Keyword Arguments:
+            time_limit {float} -- Time limit of each solve in seconds (default: {None})
+
+        Returns:
+            ndarray -- the adversarial example, None if there is none
+        """
+        if ord not in [1, np.inf]:
+            raise ValueError("ord %s not supported by the MILP attack" % str(ord))
+        milp, LinearConstraint, Bounds = _import_milp()
+
+        target_x = np.asarray(target_x, dtype=np.float64)
+        n_preds = self.n_preds
+        weights, below = self._get_objective(target_x, ord)
+        tree_rows, tree_cols, tree_vals, n_tree_rows = self.tree_rows
+
+        if ord == np.inf:
+            # t >= weight * p below target_x, t >= weight * (1 - p) above
+            n_vars = n_preds + self.n_leaves + 1
+            r = np.arange(n_preds)
+            A = sp.csr_matrix((
+                np.concatenate((tree_vals, np.where(below, weights, -weights),
+                                -np.ones(n_preds))),
+                (np.concatenate((tree_rows, n_tree_rows + r, n_tree_rows + r)),
+                 np.concatenate((tree_cols, r, np.full(n_preds, n_vars - 1))))),
+                shape=(n_tree_rows + n_preds, n_vars))
+            b_ub = np.concatenate((self.tree_b_ub, np.where(below, 0, -weights)))
+            c = np.zeros(n_vars)
+            c[-1] = 1
+        else:
+            n_vars = n_preds + self.n_leaves
+            A = sp.csr_matrix((tree_vals, (tree_rows, tree_cols)),
+                              shape=(n_tree_rows, n_vars))
+            b_ub = self.tree_b_ub
+            c = np.zeros(n_vars)
+            c[:n_preds] = np.where(below, weights, -weights)
+
+        integrality = np.zeros(n_vars)
+        integrality[:n_preds + self.n_leaves] = 1
+        ub = np.ones(n_vars)
+        ub[n_preds + self.n_leaves:] = np.inf
+        A_eq = self.A_eq
+        if n_vars > A_eq.shape[1]:
+            A_eq = sp.hstack((A_eq, sp.csr_matrix((A_eq.shape[0], 1)))).tocsr()
+        options = {} if time_limit is None else {'time_limit': time_limit}
+
+        best = (np.inf, None)
+        for k in range(self.leaf_probas.shape[1]):
+            if k == target_class:
+                continue
+            # class k gets a larger probability sum than target_class
+            vote = np.zeros(n_vars)
+            vote[n_preds:n_preds + self.n_leaves] = \
+                    self.leaf_probas[:, target_class] - self.leaf_probas[:, k]
+            constraints = [
+                LinearConstraint(A, -np.inf, b_ub),
+                LinearConstraint(A_eq, 1, 1),
+                LinearConstraint(vote.reshape((1, -1)), -np.inf, -VOTE_TOL),
+            ]
+            res = milp(c, constraints=constraints, integrality=integrality,
+                       bounds=Bounds(np.zeros(n_vars), ub), options=options)
+            if res.x is not None and res.fun < best[0]:
+                best = (res.fun, res.x)
+
+        if best[1] is None:
+            return None
+
+        # project onto the intersection of the selected leaves so the
+        # example does not depend on the solver tolerance
+        lower = np.full(self.n_features, -np.inf)
+        upper = np.full(self.n_features, np.inf)
+        for s, boxes in zip(self.leaf_slices, self.leaf_boxes):
+            leaf = np.argmax(best[1][s])
+            lower = np.maximum(lower, boxes[leaf, 0])
+            upper = np.minimum(upper, boxes[leaf, 1])
+        lower, upper = shrink_bounds(lower, upper)
+        return np.clip(target_x, lower, upper)
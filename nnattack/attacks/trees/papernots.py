@@ -6,97 +6,58 @@ import numpy as np
 from sklearn.tree import DecisionTreeClassifier
 
 from ..base import AttackModel
+from .boxes import get_leaf_boxes
 
 # DT attacks
-class decisionTreeNode:
-    def __init__(self, node_id=None, input_component=None, threshold=None,left=None,right=None,output=[], parent=None):
-        self.node_id = node_id
-        self.input_component = input_component
-        self.threshold = threshold
-        self.left = left
-        self.right = right
-        self.output = output
-        self.parent = parent
+def get_parents(clf):
+    """Parent node id of every node of the tree, -1 if there is none.
 
-def tree_parser(clf):
+    As in the reference implementation, the internal children of the root
+    have no parent, only leaves directly under the root do.
+    """
     t = clf.tree_
-    n_nodes = t.node_count
     children_left = t.children_left
     children_right = t.children_right
-    feature = t.feature
-    threshold = t.threshold
-    values = t.__getstate__()['values']
-
-    t_dict = {}
-    stack = [(0, None)]  # seed is the root node id and its parent depth
-    while len(stack) > 0:
-        node_id, parent_id = stack.pop()
-        # If we have a test node
-        if (children_left[node_id] != children_right[node_id]):
-            left = children_left[node_id]
-            right = children_right[node_id]
-            input_component = feature[node_id]
-            thres = threshold[node_id]
-            output = values[node_id]
 
-            stack.append((left, node_id))
-            stack.append((right, node_id))
-            if parent_id:
-                t_dict[str(node_id)] = decisionTreeNode(str(node_id), input_component,
-                                                   thres, str(left), str(right), output, str(parent_id))
-            else:
-                t_dict[str(node_id)] = decisionTreeNode(str(node_id), input_component,
-                                                   thres, str(left), str(right), output, None)
-        else:
-            input_component = feature[node_id]
-            thres = threshold[node_id]
-            output = values[node_id]
-            t_dict[str(node_id)] = decisionTreeNode(str(node_id), input_component,
-                                                   thres, None, None, output, str(parent_id))
-    return t_dict
+    parents = -np.ones(t.node_count, dtype=np.intp)
+    inner = np.where(children_left != children_right)[0]
+    parents[children_left[inner]] = inner
+    parents[children_right[inner]] = inner
+    inner_root_children = np.logical_and(
+            parents == 0, children_left != children_right)
+    parents[inner_root_children] = -1
+    return parents
 
-def prediction(decisionTree_instance, sample, argmax=True, node_index=False):
-    node = decisionTree_instance['0']
-    while node.left or node.right:
-        if float(sample[int(node.input_component)]) <= float(node.threshold):
-            node = decisionTree_instance[node.left]
-        else:
-            node = decisionTree_instance[node.right]
-
-    if argmax:
-        return np.argmax(node.output)
-    else:
-        if node_index == False:
-            return node.output
-        else:
-            return str(node.node_id)
+def find_adv(clf, parents, node_preds, leaf_id):
+    t = clf.tree_
+    children_left = t.children_left
+    children_right = t.children_right
+    feature = t.feature
+    threshold = t.threshold
 
-def find_adv(decisionTree_instance, sample):
-    legitimate_classification_node = decisionTree_instance[prediction(decisionTree_instance, sample, argmax=False, node_index=True)]
-    legitimate_class = prediction(decisionTree_instance, sample, argmax=True)
-    ancestor = legitimate_classification_node
-    adv_node = legitimate_classification_node
+    legitimate_class = node_preds[leaf_id]
+    ancestor = leaf_id
+    adv_node = leaf_id
     previous_ancestor = ancestor
-    while np.argmax(adv_node.output) == legitimate_class and ancestor.parent:
-        # is adv node on the left of its parent?
+    while node_preds[adv_node] == legitimate_class and parents[ancestor] != -1:
+        parent = parents[ancestor]
         list_components_left = [] #list of nodes where we went left
         list_components_right = [] #list of nodes where we went right
-        if ancestor.node_id == decisionTree_instance[ancestor.parent].left:
-            list_components_right.append([decisionTree_instance[ancestor.parent].input_component,
-                                          decisionTree_instance[ancestor.parent].threshold])
-            adv_node = decisionTree_instance[decisionTree_instance[ancestor.parent].right]
+        # is adv node on the left of its parent?
+        if ancestor == children_left[parent]:
+            list_components_right.append([feature[parent], threshold[parent]])
+            adv_node = children_right[parent]
         else: # no, it is on the right
-            list_components_left.append([decisionTree_instance[ancestor.parent].input_component,
-                                         decisionTree_instance[ancestor.parent].threshold])
-            adv_node = decisionTree_instance[decisionTree_instance[ancestor.parent].left]
-        if adv_node.input_component:
-            list_components_left.append([adv_node.input_component, adv_node.threshold])
-        while adv_node.left or adv_node.right:
-            adv_node = decisionTree_instance[adv_node.left]
-            if adv_node.input_component:
-                list_components_left.append([adv_node.input_component, adv_node.threshold])
+            list_components_left.append([feature[parent], threshold[parent]])
+            adv_node = children_left[parent]
+        if feature[adv_node]:
+            list_components_left.append([feature[adv_node], threshold[adv_node]])
+        while children_left[adv_node] != children_right[adv_node]:
+            adv_node = children_left[adv_node]
+            if feature[adv_node]:
+                list_components_left.append([feature[adv_node], threshold[adv_node]])
         previous_ancestor = ancestor
-        ancestor = decisionTree_instance[ancestor.parent]
+        ancestor = parent
     return previous_ancestor, adv_node, list_components_left, list_components_right
 
 class Papernots(AttackModel):
@@ -106,7 +67,10 @@ class Papernots(AttackModel):
         self.clf = clf
         self.random_state = random_state
 
-        self.tree_structure = tree_parser(clf)
+        leaves, _, preds = get_leaf_boxes(clf)
+        self.parents = get_parents(clf)
+        self.node_preds = -np.ones(clf.tree_.node_count, dtype=np.intp)
+        self.node_preds[leaves] = preds
 
     def fit(self, X, y):
         pass
@@ -124,12 +88,14 @@ class Papernots(AttackModel):
 
         pert_X = np.zeros_like(X)
         pred_y = self.clf.predict(X)
+        leave_id = self.clf.apply(X)
 
         for sample_id in range(len(X)):
             if pred_y[sample_id] != y[sample_id]:
                continue
             x = np.copy(X[sample_id])
-            _, _, l, r = find_adv(self.tree_structure, x)
+            _, _, l, r = find_adv(self.clf, self.parents, self.node_preds,
+                                  leave_id[sample_id])
             for (pixel, thres) in l:
                 if pixel > 0:
                     x[pixel] = min(x[pixel], thres - 1e-3)
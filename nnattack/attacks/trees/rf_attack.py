@@ -1,187 +1,98 @@
-import gc
-from itertools import product, permutations
-
 import numpy as np
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.neighbors import KDTree
 from tqdm import tqdm
-import joblib
-from joblib import Parallel, delayed
 
 from ..base import AttackModel
-from .dt_opt import get_tree_constraints
-from ..utils import solve_lp, solve_qp
-
-def constraint_list_to_matrix(r):
-    rG, rh = [], []
-    rC, rd = [], []
-    n_dim = len(r) // 2
-
-    for i in range(n_dim):
-        temp = np.zeros(n_dim)
-        temp[i] = 1
-        if np.isclose(r[i], -r[i+n_dim]):
-            rC.append(temp)
-            rd.append(r[i])
-        else:
-            temp2 = np.zeros(n_dim)
-            temp2[i] = -1
-            rG.append(temp)
-            rh.append(r[i])
-            rG.append(temp2)
-            rh.append(r[i+n_dim])
-
-    rG, rh = np.array(rG).astype(np.float32), np.array(rh).astype(np.float32)
-    if len(rC) == 0 or len(rd) == 0:
-        rC, rd = None, None
-    else:
-        rC, rd = np.array(rC).astype(np.float32), np.array(rd).astype(np.float32)
-    return rG, rh, rC, rd
-
-    #for i in range(len(r)):
-    #    if r[i] < np.inf:
-    #        temp = np.zeros(n_dim)
-    #        if i < n_dim:
-    #            temp[i] = 1
-    #        else:
-    #            temp[i-n_dim] = -1
-    #        rG.append(temp)
-    #        rh.append(r[i])
-    #return np.array(rG).astype(np.float32), np.array(rh).astype(np.float32)
-
-def union_constraints(G, h):
-    assert np.all(np.abs(G).sum(1) == np.ones(len(G)))
-    if len(np.shape(G)) <= 1:
-        return np.array([]), np.array([])
-    n_dim = np.shape(G)[1]
-
-    r = [np.inf for i in range(n_dim*2)]
-    for Gi, hi in zip(G, h):
-        if Gi.sum() == 1:
-            idx = np.where(Gi == 1)[0][0]
-            r[idx] = hi if r[idx] is None else min(r[idx], hi)
-        elif Gi.sum() == -1:
-            idx = np.where(Gi == -1)[0][0] + n_dim
-            r[idx] = hi if r[idx] is None else min(r[idx], hi)
-        else:
-            raise ValueError()
-    return r
+from .boxes import (MAX_BATCH_ELEMENTS, bounds_to_regions, get_leaf_boxes,
+                    nearest_box_points, regions_to_bounds)
+
+def _get_leaf_regions(tree_clf):
+    leaves, boxes, _ = get_leaf_boxes(tree_clf)
+    return leaves, bounds_to_regions(boxes[:, 0], boxes[:, 1])
 
 def tree_instance_constraint(tree_clf, X):
-    node_indicator = tree_clf.decision_path(X)
+    """Region of the leaf every sample falls into,
+    shape=(n_samples, 2*n_features)."""
+    leaves, regions = _get_leaf_regions(tree_clf)
     leave_id = tree_clf.apply(X)
-    feature = tree_clf.tree_.feature
-    threshold = tree_clf.tree_.threshold
-    n_dims = X.shape[1]
-
-    ret = []
-    for sample_id in range(len(X)):
-        node_index = node_indicator.indices[node_indicator.indptr[sample_id]:
-                                            node_indicator.indptr[sample_id + 1]]
-        r = [np.inf for i in range(n_dims*2)]
-        for node_id in node_index:
-            if leave_id[sample_id] == node_id:
-                break
-
-            # scikit-learn uses float32 internally
-            if (X[sample_id, feature[node_id]].astype(np.float32) <= threshold[node_id]).astype(np.float32):
-                #threshold_sign = "<="
-                idx = feature[node_id]
-                hi = threshold[node_id]
-                r[idx] = hi if r[idx] is None else min(r[idx], hi)
-            else:
-                #threshold_sign = ">"
-                idx = feature[node_id] + n_dims
-                hi = -threshold[node_id]
-                r[idx] = hi if r[idx] is None else min(r[idx], hi)
-        ret.append(r)
-
-    return np.asarray(ret).astype(np.float32)
-
-def rev_get_sol_l2(target_x, target_y: int, regions, clf, trnX=None):
-    fet_dim = np.shape(target_x)[0]
-    candidates = []
-    regions = [constraint_list_to_matrix(r) for r in regions]
-    for i, (G, h, C, d) in enumerate(regions):
-        #c = np.concatenate((np.zeros(fet_dim), np.ones(1))).reshape((-1, 1))
-
-        Q = 2 * np.eye(fet_dim)
-        q = -2 * target_x
-        temph = (h - 1e-6).reshape((-1, 1))
-
-        if trnX is None:
-            status, sol = solve_qp(Q, q, G, temph, len(q), C=C, d=d)
-        else:
-            status, sol = solve_qp(Q, q, G, temph, len(q), C=C, d=d, init_x=trnX[i].reshape((-1, 1)))
-
-        if status == 'optimal':
-            ret = np.array(sol).reshape(-1)
-
-            if clf.predict([ret])[0] != target_y:
-                candidates.append(ret - target_x)
-            else:
-                raise ValueError("Shouldn't happend, unsuccessful attack")
-                # a dimension is too close to the boundary region too small
-                # just use the traning data as
-                #if trnX is not None:
-                #    candidates.append(trnX[i] - target_x)
-                #print("region too small %d" % i)
-        elif status == 'infeasible_inaccurate':
-            print(status)
-            candidates.append(trnX[i] - target_x)
-        else:
-            print(status)
-
-    norms = np.linalg.norm(candidates, ord=2, axis=1)
-    return candidates[norms.argmin()]
-
-def rev_get_sol_linf(target_x, target_y: int, regions, clf,
-        trnX=None):
-    fet_dim = np.shape(target_x)[0]
-    candidates = []
-    regions = [constraint_list_to_matrix(r) for r in regions]
-    for i, (G, h, C, d) in enumerate(regions):
-        c = np.concatenate((np.zeros(fet_dim), np.ones(1))).reshape((-1, 1))
-
-        G2 = np.hstack((np.eye(fet_dim), -np.ones((fet_dim, 1))))
-        G3 = np.hstack((-np.eye(fet_dim), -np.ones((fet_dim, 1))))
-        G = np.hstack((G, np.zeros((G.shape[0], 1))))
-        G = np.vstack((G, G2, G3))
-        h = np.concatenate((h, target_x, -target_x))
-
-        temph = (h - 1e-6).reshape((-1, 1))
-
-        if C is not None:
-            C = np.hstack((C, np.zeros((C.shape[0], 1))))
-
-        if trnX is None:
-            status, sol = solve_lp(c, G, temph, len(c), C=C, d=d)
-        else:
-            init_x = np.concatenate((
-                trnX[i],
-                [np.linalg.norm(trnX[i]-target_x, ord=np.inf)])).reshape((-1, 1))
-            status, sol = solve_lp(c, G, temph, len(c), C=C, d=d, init_x=init_x)
-
-        if status == 'optimal':
-            ret = np.array(sol).reshape(-1)[:-1]
-
-            if clf.predict([ret])[0] != target_y:
-                candidates.append(ret - target_x)
-            else:
-                # a dimension is too close to the boundary
-                # region too small
-                # just use the traning data as
-                if trnX is not None:
-                    candidates.append(trnX[i] - target_x)
-                print("region too small %d" % i)
-        elif status == 'infeasible_inaccurate':
-            candidates.append(trnX[i] - target_x)
-        else:
-            print(status)
-
-    norms = np.linalg.norm(candidates, ord=np.inf, axis=1)
-    return candidates[norms.argmin()]
-
+    return regions[np.searchsorted(leaves, leave_id)].astype(np.float32)
+
+def forest_instance_constraint(clf, X, batch_size=None):
+    """Region of the forest every sample falls into, the intersection of its
+    leaf regions over all the trees, shape=(n_samples, 2*n_features)."""
+    tables = [_get_leaf_regions(tree_clf) for tree_clf in clf.estimators_]
+    leave_ids = clf.apply(X)
+    n_dims = np.shape(X)[1]
+    if batch_size is None:
+        batch_size = max(1, MAX_BATCH_ELEMENTS // (len(tables) * 2 * n_dims))
+
+    ret = np.empty((len(X), 2 * n_dims), dtype=np.float32)
+    for start in range(0, len(X), batch_size):
+        ids = leave_ids[start:start+batch_size]
+        # (batch_size, n_trees, 2*n_features), the upper bounds and the
+        # negated lower bounds both intersect with a min
+        r = np.stack([regions[np.searchsorted(leaves, ids[:, i])]
+                      for i, (leaves, regions) in enumerate(tables)], axis=1)
+        ret[start:start+batch_size] = r.min(axis=1)
+    return ret
+
+def get_forest_regions(clf):
+    """Regions of a random forest, boxes on which the forest predicts a
+    single class. Cached on the estimator.
+
+    The boxes are intersected one tree at a time in a depth first search
+    over the leaves of the next tree. A branch stops as soon as its box is
+    empty, or as soon as the remaining trees can no longer change the
+    predicted class.
+
+    Arguments:
+        clf {RandomForestClassifier} -- fitted random forest
+
+    Returns:
+        regions {ndarray, shape=(n_regions, 2*n_features)} -- regions in the [upper, -lower] format
+        region_preds {ndarray, shape=(n_regions)} -- index in clf.classes_ of the class predicted in each region
+    """
+    trees = [tree_clf.tree_ for tree_clf in clf.estimators_]
+    cached = getattr(clf, '_forest_regions', None)
+    if cached is not None and len(cached[0]) == len(trees) \
+            and all(a is b for a, b in zip(cached[0], trees)):
+        return cached[1]
+
+    leaf_boxes, leaf_probas = [], []
+    for tree_clf in clf.estimators_:
+        leaves, boxes, _ = get_leaf_boxes(tree_clf)
+        value = tree_clf.tree_.value[leaves, 0]
+        leaf_boxes.append(boxes)
+        leaf_probas.append(value / value.sum(axis=1, keepdims=True))
+
+    n_estimators = len(trees)
+    n_dims = leaf_boxes[0].shape[2]
+    regions, region_preds = [], []
+    # (index of the next tree, lower bounds, upper bounds, sum of the leaf
+    # probabilities so far)
+    stack = [(0, np.full(n_dims, -np.inf), np.full(n_dims, np.inf),
+              np.zeros(clf.n_classes_))]
+    while len(stack) > 0:
+        i, lower, upper, votes = stack.pop()
+        # every tree adds at most one to the probability sum of a class
+        top = np.sort(votes)[::-1]
+        if i == n_estimators or len(top) == 1 or top[0] - top[1] > n_estimators - i:
+            regions.append(bounds_to_regions(lower, upper))
+            # the forest predicts with the mean of the leaf probabilities,
+            # not the majority vote
+            region_preds.append(np.argmax(votes))
+            continue
+
+        lo = np.maximum(lower, leaf_boxes[i][:, 0])
+        hi = np.minimum(upper, leaf_boxes[i][:, 1])
+        # lower bounds are strict, x > lower
+        for j in np.where(np.all(lo < hi, axis=1))[0][::-1]:
+            stack.append((i+1, lo[j], hi[j], votes + leaf_probas[i][j]))
+
+    ret = (np.asarray(regions), np.asarray(region_preds))
+    clf._forest_regions = (trees, ret)
+    return ret
 
 def binary_search(x, y, x0, predict_fn, ord):
     if predict_fn([x]) != y:
@@ -210,14 +121,13 @@ class RFAttack(AttackModel):
             trny {ndarray, shape=(n_samples)} -- Training label
             clf {RandomForestClassifier} -- The Random Forest classifier
             ord {int} -- Order of the norm for perturbation distance, see numpy.linalg.norm for more information
-            method {str} -- 'all' means optimal attack (RBA-Exact), 'rev' means RBA-Approx
+            method {str} -- 'all' means optimal attack (RBA-Exact), 'rev' means RBA-Approx, 'milp' means optimal attack solved as a MILP (ord 1 or np.inf only)
 
         Keyword Arguments:
             n_searches {int} -- number of regions to search, only used when method=='rev' (default: {-1})
             random_state {[type]} -- random seed (default: {None})
         """
         super().__init__(ord=ord)
-        paths, constraints = [], []
         self.clf = clf
         self.method = method
         self.n_searches = n_searches
@@ -231,48 +141,8 @@ class RFAttack(AttackModel):
             self.kd_tree = None
 
         if self.method == 'all':
-            for tree_clf in clf.estimators_:
-                path, constraint = get_tree_constraints(tree_clf)
-                paths.append(path)
-                constraints.append(constraint)
-
-            n_classes = clf.n_classes_
-            n_estimators = len(clf.estimators_)
-            self.regions = []
-            self.region_preds = []
-            vacuan_regions = 0
-
-            for res in product(range(n_classes), repeat=n_estimators):
-                perm_consts = [list() for _ in range(n_estimators)]
-
-                for i in range(n_estimators):
-                    value = clf.estimators_[i].tree_.value
-                    path = paths[i]
-                    constraint = constraints[i]
-
-                    for p in range(len(path)):
-                        if np.argmax(value[path[p][-1]]) == res[i]:
-                            perm_consts[i].append(constraint[p])
-
-                for pro in product(*perm_consts):
-                    r = union_constraints(
-                            np.vstack([j[0] for j in pro]),
-                            np.concatenate([j[1] for j in pro]),
-                        )
-                    G, h, C, d= constraint_list_to_matrix(r)
-                    status, _ = solve_lp(
-                                np.zeros((len(G[0]))), G, h.reshape(-1, 1),
-                                len(G[0]), C=C, d=d,
-                            )
-                    if status == 'optimal':
-                        self.region_preds.append(np.argmax(np.bincount(res)))
-                        #self.regions.append((G, h))
-                        self.regions.append(r)
-                    else:
-                        vacuan_regions += 1
-
+            self.regions, self.region_preds = get_forest_regions(clf)
             print(f"number of regions: {len(self.regions)}")
-            print(f"number of vacuan regions: {vacuan_regions}")
 
         elif self.method == 'rev':
             #Gss, hss = [list() for _ in trnX], [list() for _ in trnX]
@@ -287,87 +157,77 @@ class RFAttack(AttackModel):
             #    t1, t2 = np.vstack(Gs), np.concatenate(hs)
             #    self.regions.append(union_constraints(t1, t2))
 
-            r = tree_instance_constraint(clf.estimators_[0], trnX)
-            for tree_clf in clf.estimators_[1:]:
-                t = tree_instance_constraint(tree_clf, trnX)
-                r = np.min(np.concatenate(
-                    (r[np.newaxis, :], t[np.newaxis, :])), axis=0)
-            self.regions = r
-
-            for i in range(len(trnX)):
-                G, h, C, d = constraint_list_to_matrix(self.regions[i])
-                if C is not None and d is not None:
-                    assert np.all(
-                            np.logical_and(
-                                np.dot(G, trnX[i]) <= (h + 1e-8),
-                                np.isclose(np.dot(C, trnX[i]), d),
-                            )), i
-                else:
-                    assert np.all(np.dot(G, trnX[i]) <= (h + 1e-8)), i
-                #assert np.all(np.dot(np.vstack(Gss[i]), trnX[i]) <= np.concatenate(hss[i])), i
-                #assert np.all(np.dot(G, trnX[i]) <= h), i
+            self.regions = forest_instance_constraint(clf, trnX)
+
+            lower, upper = regions_to_bounds(self.regions)
+            assert np.all(np.logical_and(trnX <= (upper + 1e-8),
+                                         trnX >= (lower - 1e-8)))
 
         elif self.method == 'binrev':
             pass
+        elif self.method == 'milp':
+            from .milp import ForestMILP
+            if self.ord not in [1, np.inf]:
+                raise ValueError("ord %s not supported by the MILP attack" % str(self.ord))
+            self.milp = ForestMILP(clf.estimators_, trnX.shape[1])
         else:
             raise ValueError("Not supported method: %s", self.method)
 
+    def _project(self, X, y, regions, mask, fallback=None):
+        """Nearest point of the closest allowed region, samples too close to a
+        region boundary fall back to a point known to be inside the region."""
+        sols, region_ids = nearest_box_points(X, regions, self.ord, mask=mask)
+        if np.any(region_ids == -1):
+            raise ValueError("shouldn't happen")
+        pert_X = (sols - X).astype(X.dtype)
+        if fallback is not None:
+            failed = (self.clf.predict(X + pert_X) == y)
+            pert_X[failed] = fallback[region_ids[failed]] - X[failed]
+        return pert_X
+
     def perturb(self, X, y, eps=0.1):
         X = X.astype(np.float32)
-        if self.ord == 2:
-            get_sol_fn = rev_get_sol_l2
-        elif self.ord == np.inf:
-            get_sol_fn = rev_get_sol_linf
-        else:
-            raise ValueError("ord %s not supported", self.ord)
+        if self.ord not in [1, 2, np.inf]:
+            raise ValueError("ord %s not supported" % str(self.ord))
 
         clf = self.clf
         pred_y = clf.predict(X)
         pred_trn_y = clf.predict(self.trnX)
+        pert_X = np.zeros_like(X)
 
         if self.method == 'all':
-            def _helper(target_x, target_y, pred_yi):
-                if pred_yi != target_y:
-                    return np.zeros_like(target_x)
-                temp_regions = [self.regions[i] for i in range(len(self.regions)) \
-                            if self.region_preds[i] != target_y]
-                return get_sol_fn(target_x, target_y,
-                                  pred_trn_y, temp_regions, self.clf)
-
-            pert_xs = Parallel(n_jobs=4, verbose=5)(
-                delayed(_helper)(X[i], y[i], pred_y[i]) for i in range(len(X)))
-            pert_X = np.array(pert_xs)
+            regions = np.asarray(self.regions)
+            region_preds = clf.classes_[np.asarray(self.region_preds)]
+            for target_y in np.unique(y):
+                idx = np.where(np.logical_and(pred_y == y, y == target_y))[0]
+                if len(idx) > 0:
+                    pert_X[idx] = self._project(X[idx], y[idx], regions,
+                                                region_preds != target_y)
 
             assert np.all(self.clf.predict(X + pert_X) != y)
 
         elif self.method == 'rev':
-            pert_X = np.zeros_like(X)
-            for sample_id in tqdm(range(len(X)), ascii=True, desc="Perturb"):
-                if pred_y[sample_id] != y[sample_id]:
-                    continue
-                target_x, target_y = X[sample_id], y[sample_id]
+            idx = np.where(pred_y == y)[0]
+            target_y = y[idx]
+            if self.n_searches != -1:
+                ind = self.kd_tree.query(X[idx], k=len(self.trnX),
+                                         return_distance=False)
+                # only the n_searches closest regions of another label
+                cand = (pred_trn_y[ind] != target_y[:, np.newaxis])
+                cand &= (np.cumsum(cand, axis=1) <= self.n_searches)
+                mask = np.zeros((len(idx), len(self.trnX)), dtype=bool)
+                np.put_along_axis(mask, ind, cand, axis=1)
+            else:
+                mask = (pred_trn_y[np.newaxis, :] != target_y[:, np.newaxis])
 
-                if self.n_searches != -1:
-                    ind = self.kd_tree.query(
-                            target_x.reshape((1, -1)),
-                            k=len(self.trnX),
-                            return_distance=False)[0]
-                    ind = list(filter(lambda x: pred_trn_y[x] != target_y, ind))[:self.n_searches]
-                else:
-                    ind = list(filter(lambda x: pred_trn_y[x] != target_y, np.arange(len(self.trnX))))
-                temp_regions = [self.regions[i] for i in ind]
-                pert_x = get_sol_fn(target_x, y[sample_id], temp_regions, self.clf, self.trnX[ind])
+            pert_X[idx] = self._project(X[idx], target_y, self.regions, mask,
+                                        fallback=self.trnX)
+            assert np.all(self.clf.predict(X[idx] + pert_X[idx]) != target_y)
 
-                if np.linalg.norm(pert_x) != 0:
-                    assert self.clf.predict([X[sample_id] + pert_x])[0] != y[sample_id]
-                    pert_X[sample_id, :] = pert_x
-                else:
-                    raise ValueError("shouldn't happen")
         elif self.method == 'binrev':
             def predict_fn(x):
                 return clf.predict(x)
 
-            pert_X = np.zeros_like(X)
             for sample_id in tqdm(range(len(X)), ascii=True, desc="Perturb"):
                 if pred_y[sample_id] != y[sample_id]:
                     continue
@@ -385,15 +245,10 @@ class RFAttack(AttackModel):
                 canX = np.asarray([
                     binary_search(target_x, target_y, self.trnX[i], predict_fn, self.ord) for i in ind])
 
-                r = tree_instance_constraint(clf.estimators_[0], canX)
-                for tree_clf in clf.estimators_[1:]:
-                    t = tree_instance_constraint(tree_clf, canX)
-                    r = np.min(np.concatenate(
-                        (r[np.newaxis, :], t[np.newaxis, :])), axis=0)
-                temp_regions = r
+                temp_regions = forest_instance_constraint(clf, canX)
 
-                pert_x = get_sol_fn(
-                        target_x, target_y, temp_regions, clf, trnX=canX)
+                pert_x = self._project(X[sample_id:sample_id+1], y[sample_id:sample_id+1],
+                                       temp_regions, None, fallback=canX)[0]
 
                 if np.linalg.norm(pert_x) != 0:
                     assert self.clf.predict([X[sample_id] + pert_x])[0] != y[sample_id]
@@ -401,6 +256,16 @@ class RFAttack(AttackModel):
                 else:
                     raise ValueError("shouldn't happen")
 
+        elif self.method == 'milp':
+            for sample_id in tqdm(np.where(pred_y == y)[0], ascii=True, desc="Perturb"):
+                target_class = np.where(clf.classes_ == y[sample_id])[0][0]
+                adv_x = self.milp.perturb(X[sample_id], target_class, self.ord)
+                if adv_x is None:
+                    raise ValueError("shouldn't happen")
+                pert_X[sample_id] = adv_x - X[sample_id]
+
+            assert np.all(self.clf.predict(X + pert_X) != y)
+
         else:
             raise ValueError("Not supported method %s", self.method)
 
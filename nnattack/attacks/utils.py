@@ -1,14 +1,51 @@
+import atexit
+import os
+import shutil
+import tempfile
+import uuid
+
 import numpy as np
 import cvxpy as cp
 
+from ..budget import get_n_jobs
+
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+_shared_folder = None
+
+def _get_shared_folder():
+    global _shared_folder
+    if _shared_folder is None:
+        _shared_folder = tempfile.mkdtemp(prefix="nnattack_shared_")
+        atexit.register(shutil.rmtree, _shared_folder, ignore_errors=True)
+    return _shared_folder
+
+def as_shared_array(X, dtype=np.float64, max_nbytes=1e6):
+    """Validate X once and return it as a read-only, C-contiguous array.
+
+    Arrays larger than max_nbytes are written once to a memory-mapped file.
+    joblib sends memory-mapped arrays to its workers by file name, so the
+    data is not pickled again for every task.
+    """
+    X = np.ascontiguousarray(X, dtype=dtype)
+    if X.ndim != 2:
+        raise ValueError("Expected a 2d array, got shape %s" % str(X.shape))
+
+    if X.nbytes > max_nbytes:
+        file_path = os.path.join(_get_shared_folder(), "%s.npy" % uuid.uuid4().hex)
+        np.save(file_path, X)
+        return np.load(file_path, mmap_mode='r')
+
+    X = X.view()
+    X.flags.writeable = False
+    return X
+
 def solve_lp(c, G, h, n, C=None, d=None, init_x=None, n_jobs=1, solver=cp.GUROBI):
     #c = np.array(c)
     #G, h = np.array(G), np.array(h)
-    options = {'threads': n_jobs}
+    options = {'threads': get_n_jobs(n_jobs)}
     x = cp.Variable(shape=(n, 1))
     obj = cp.Minimize(c.T * x)
     if C is not None and d is not None:
@@ -0,0 +1,86 @@
+"""
+CPU budget shared by the nested parallel sections of the experiments
+
+The budget is NNATTACK_CPUS, or every CPU the process may run on. A
+parallel section asks get_n_jobs for its number of workers and runs its
+tasks through budgeted_delayed, which splits its own share among the
+workers and limits their BLAS/OpenMP threads to it. With the default of
+as many workers as CPUs, every worker gets one CPU and the sections
+nested in it run sequentially, one level of parallelism.
+"""
+import os
+
+from joblib import delayed
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                   'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']
+
+# share of the budget of this process, set while it runs a budgeted task
+_share = None
+
+
+def total_cpus():
+    """NNATTACK_CPUS, or the number of CPUs this process may run on."""
+    if os.environ.get('NNATTACK_CPUS'):
+        return max(1, int(os.environ['NNATTACK_CPUS']))
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def available_cpus():
+    """CPUs of this process, its share when it runs a budgeted task."""
+    return _share if _share is not None else total_cpus()
+
+
+def get_n_jobs(n_jobs=-1):
+    """Number of workers of a parallel section asking for n_jobs, -1 or None
+    for as many as available, never more than available_cpus()."""
+    available = available_cpus()
+    if n_jobs is None or n_jobs < 0:
+        return available
+    return max(1, min(n_jobs, available))
+
+
+class Budgeted():
+    """fn running with a share of cpus CPUs, its nested sections and BLAS
+    threads included.
+
+    Arguments:
+        fn {callable} -- The task
+        cpus {int} -- CPUs of the task
+    """
+    def __init__(self, fn, cpus):
+        self.fn = fn
+        self.cpus = cpus
+
+    def __call__(self, *args, **kwargs):
+        global _share
+        prev_share = _share
+        prev_env = {k: os.environ.get(k) for k in THREAD_ENV_VARS}
+        _share = self.cpus
+        # read by the processes and thread pools started from now on
+        os.environ.update({k: str(self.cpus) for k in THREAD_ENV_VARS})
+        try:
+            if threadpool_limits is None:
+                return self.fn(*args, **kwargs)
+            with threadpool_limits(limits=self.cpus):
+                return self.fn(*args, **kwargs)
+        finally:
+            _share = prev_share
+            for k, v in prev_env.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+
+
+def budgeted_delayed(fn, n_jobs):
+    """joblib.delayed of fn for a section of n_jobs workers, each with an
+    equal share of the CPUs of this process."""
+    return delayed(Budgeted(fn, max(1, available_cpus() // max(1, n_jobs))))
@@ -0,0 +1,161 @@
+"""
+Content addressed on-disk cache of numpy arrays shared by the experiments
+"""
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from functools import lru_cache
+
+import joblib
+import numpy as np
+
+CACHE_DIR = os.environ.get('NNATTACK_CACHE_DIR', './cache/')
+# size cap of each cache in bytes, the least recently used entries go first
+MAX_CACHE_BYTES = 2 * 1024**3
+
+
+def hash_key(*parts):
+    """Hex digest of arrays and json serializable parameters."""
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            h.update(json.dumps([part.dtype.str, part.shape]).encode())
+            h.update(part)
+        else:
+            h.update(json.dumps(part, sort_keys=True, default=repr).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def source_digest(*subpackages):
+    """Digest of the sources of the nnattack subpackages, the entries they
+    computed are stale once it changes."""
+    sources = []
+    for subpackage in subpackages:
+        package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   subpackage)
+        for root, dirs, files in os.walk(package_dir):
+            dirs.sort()
+            for f in sorted(files):
+                if f.endswith('.py'):
+                    with open(os.path.join(root, f), 'r') as fp:
+                        sources.append(fp.read())
+    return hash_key(sources)
+
+
+def pack_rng_state():
+    """State of the global numpy random generator as one array."""
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return np.concatenate((keys, [pos, has_gauss, cached_gaussian]))
+
+
+def unpack_rng_state(state):
+    """Sets the global numpy random generator to a pack_rng_state array."""
+    state = np.asarray(state)
+    np.random.set_state(('MT19937', state[:-3].astype(np.uint32),
+                         int(state[-3]), int(state[-2]), float(state[-1])))
+
+
+class DiskCache():
+    """Arrays stored as .npy files named by their key.
+
+    Writes go to a temporary file renamed into place, so concurrent
+    experiments never read a partial entry. Reading an entry refreshes its
+    modification time, which orders the eviction once the cache is larger
+    than max_bytes.
+
+    Arguments:
+        name {str} -- Sub directory of the cache
+
+    Keyword Arguments:
+        cache_dir {str} -- Root directory, CACHE_DIR if None (default: {None})
+        max_bytes {int} -- Size cap of the cache (default: {MAX_CACHE_BYTES})
+    """
+    suffix = '.npy'
+
+    def __init__(self, name, cache_dir=None, max_bytes=MAX_CACHE_BYTES):
+        self.path = os.path.join(cache_dir or CACHE_DIR, name)
+        self.max_bytes = max_bytes
+
+    def _file(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def _load(self, file_path, mmap_mode):
+        return np.load(file_path, mmap_mode=mmap_mode, allow_pickle=False)
+
+    def _dump(self, value, file_path):
+        with open(file_path, 'wb') as f:
+            np.save(f, np.asarray(value), allow_pickle=False)
+
+    def get(self, key, mmap_mode=None):
+        """The entry stored under key, None if there is none.
+
+        mmap_mode is passed to np.load (joblib.load), 'r' maps the arrays
+        read-only and 'c' copy-on-write instead of reading them.
+        """
+        file_path = self._file(key)
+        try:
+            ret = self._load(file_path, mmap_mode)
+            os.utime(file_path)
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            return None
+        return ret
+
+    def set(self, key, value):
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        try:
+            self._dump(value, tmp_path)
+            os.replace(tmp_path, self._file(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self._evict(keep=self._file(key))
+
+    def get_or_compute(self, key, fn):
+        """The array stored under key, computed by fn() and stored if missing."""
+        ret = self.get(key)
+        if ret is None:
+            ret = fn()
+            self.set(key, ret)
+        return ret
+
+    def _evict(self, keep=None):
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith(self.suffix):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, file_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if file_path == keep:
+                continue
+            try:
+                os.unlink(file_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class ObjectCache(DiskCache):
+    """Python objects pickled with joblib, the numpy arrays they hold are
+    memory-mapped by get with mmap_mode. Same arguments as DiskCache."""
+    suffix = '.joblib'
+
+    def _load(self, file_path, mmap_mode):
+        return joblib.load(file_path, mmap_mode=mmap_mode)
+
+    def _dump(self, value, file_path):
+        joblib.dump(value, file_path)
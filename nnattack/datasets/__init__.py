@@ -1,13 +1,105 @@
+import functools
+import hashlib
+import inspect
+import os
+
 import numpy as np
+import sklearn
 from sklearn.model_selection import train_test_split
 from sklearn.datasets import load_svmlight_file
 from sklearn.decomposition import PCA
 
 from autovar.base import RegisteringChoiceType, register_var, VariableClass
-from .cnn_feature import extract_feature
+from ..cache import DiskCache, hash_key, pack_rng_state, unpack_rng_state
 
 LINF_EPS = [0.01 * i for i in range(0, 81, 1)]
 
+DATASET_CACHE = DiskCache('datasets')
+_file_digests = {}
+
+# files keras.datasets downloads, the cached datasets built from them are
+# invalidated when they change
+KERAS_DATASETS_DIR = os.path.join(
+    os.environ.get('KERAS_HOME', os.path.join(os.path.expanduser('~'), '.keras')),
+    'datasets')
+MNIST_FILES = [os.path.join(KERAS_DATASETS_DIR, 'mnist.npz')]
+FASHION_MNIST_FILES = [os.path.join(KERAS_DATASETS_DIR, 'fashion-mnist', f)
+                       for f in ['train-labels-idx1-ubyte.gz', 'train-images-idx3-ubyte.gz',
+                                 't10k-labels-idx1-ubyte.gz', 't10k-images-idx3-ubyte.gz']]
+CIFAR10_FILES = [os.path.join(KERAS_DATASETS_DIR, 'cifar-10-batches-py', f)
+                 for f in ['data_batch_%d' % i for i in range(1, 6)] + ['test_batch']]
+
+def _file_digest(path):
+    """sha256 of a source file, None if it is missing."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_digests:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _file_digests[memo_key] = h.hexdigest()
+    return _file_digests[memo_key]
+
+def _as_outputs(ret):
+    """Outputs of a dataset as ndarrays, np.matrix included, and the eps list."""
+    return tuple(np.asarray(r) for r in ret[:-1]) + (list(ret[-1]), )
+
+def cached_dataset(*source_files):
+    """Stores the outputs of a dataset in DATASET_CACHE, later runs map
+    them read-only instead of parsing the files and refitting the PCA.
+
+    The key is the dataset variable string, random_seed, ord, the digests
+    of source_files, the source of the function, the sklearn version (PCA)
+    and the state of the global numpy random generator. The state after
+    the call is stored with the outputs and restored on a hit, so the
+    samples drawn afterwards are the same as without the cache. The arrays
+    are returned as ndarrays (np.matrix outputs are converted) and the last
+    output, the eps list, as a list, whether the cache is hit or not.
+
+    A dataset with a missing source file, not downloaded yet, is not cached.
+
+    Arguments:
+        source_files {str} -- Files the dataset is read from
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+        source = inspect.getsource(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            auto_var = signature.bind(*args, **kwargs).arguments['auto_var']
+            digests = [_file_digest(f) for f in source_files]
+            if None in digests:
+                return _as_outputs(fn(*args, **kwargs))
+            key = hash_key(
+                auto_var.get_variable_name("dataset"),
+                auto_var.get_var("random_seed"), auto_var.get_var("ord"),
+                digests, source, sklearn.__version__, pack_rng_state())
+
+            n_outputs = DATASET_CACHE.get(key)
+            if n_outputs is not None:
+                ret = [DATASET_CACHE.get(f"{key}_{i}", mmap_mode='r')
+                       for i in range(int(n_outputs))]
+                rng_state = DATASET_CACHE.get(f"{key}_rng")
+                if rng_state is not None and all(r is not None for r in ret):
+                    unpack_rng_state(rng_state)
+                    return tuple(ret[:-1]) + (ret[-1].tolist(), )
+
+            ret = _as_outputs(fn(*args, **kwargs))
+            for i, r in enumerate(ret):
+                DATASET_CACHE.set(f"{key}_{i}", r)
+            DATASET_CACHE.set(f"{key}_rng", pack_rng_state())
+            # written last, an entry is only used once all its parts exist
+            DATASET_CACHE.set(key, np.array(len(ret)))
+            return ret
+        wrapper.__signature__ = signature
+        return wrapper
+    return decorator
+
 class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
     """Defines the dataset to use"""
     var_name = 'dataset'
@@ -47,6 +139,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var()
     @staticmethod
+    @cached_dataset("./nnattack/datasets/files/german.numer")
     def german(auto_var, var_value, inter_var):
         # https://www.csie.ntu.edu.tw/~cjlin/libsvmtools/datasets/binary.html#german.numer
         X, y = load_svmlight_file("./nnattack/datasets/files/german.numer")
@@ -57,6 +150,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var(argument=r"splice(?P<n_dims>_pca\d+)?", shown_name="splice")
     @staticmethod
+    @cached_dataset("./nnattack/datasets/files/splice")
     def splice(auto_var, var_value, inter_var, n_dims):
         X, y = load_svmlight_file("./nnattack/datasets/files/splice")
         X = X.todense()
@@ -72,6 +166,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var()
     @staticmethod
+    @cached_dataset("./nnattack/datasets/files/svmguide3")
     def svmguide3(auto_var, var_value, inter_var):
         X, y = load_svmlight_file("./nnattack/datasets/files/svmguide3")
         X = X.todense()
@@ -81,6 +176,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var()
     @staticmethod
+    @cached_dataset("./nnattack/datasets/files/diabetes")
     def diabetes(auto_var, var_value, inter_var):
         X, y = load_svmlight_file("./nnattack/datasets/files/diabetes")
         X = X.todense()
@@ -90,6 +186,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var()
     @staticmethod
+    @cached_dataset("./nnattack/datasets/files/fourclass")
     def fourclass(auto_var, var_value, inter_var):
         # https://www.csie.ntu.edu.tw/~cjlin/libsvmtools/datasets/binary/fourclass
         X, y = load_svmlight_file("./nnattack/datasets/files/fourclass")
@@ -100,6 +197,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var(shown_name="austr.")
     @staticmethod
+    @cached_dataset("./nnattack/datasets/files/australian")
     def australian(auto_var, var_value, inter_var):
         # https://www.csie.ntu.edu.tw/~cjlin/libsvmtools/datasets/binary/australian
         X, y = load_svmlight_file("./nnattack/datasets/files/australian")
@@ -111,6 +209,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var()
     @staticmethod
+    @cached_dataset("./nnattack/datasets/files/breast-cancer")
     def cancer(auto_var, var_value, inter_var):
         # https://www.csie.ntu.edu.tw/~cjlin/libsvmtools/datasets/binary/breast-cancer
         X, y = load_svmlight_file("./nnattack/datasets/files/breast-cancer")
@@ -122,6 +221,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var(argument=r"ijcnn1_(?P<n_samples>\d+)", shown_name="ijcnn")
     @staticmethod
+    @cached_dataset("./nnattack/datasets/files/ijcnn1.tr")
     def ijcnn1(auto_var, var_value, inter_var, n_samples):
         n_samples = int(n_samples)
         X, y = load_svmlight_file("./nnattack/datasets/files/ijcnn1.tr")
@@ -139,6 +239,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var(argument=r"covtypebin_(?P<n_samples>\d+)", shown_name="covtype")
     @staticmethod
+    @cached_dataset("./nnattack/datasets/files/covtype.libsvm.binary")
     def covtypebin(auto_var, var_value, inter_var, n_samples):
         # https://www.csie.ntu.edu.tw/~cjlin/libsvmtools/datasets/binary/covtype.libsvm.binary.bz2
         n_samples = int(n_samples)
@@ -157,6 +258,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var(argument=r"covtype_(?P<n_samples>\d+)")
     @staticmethod
+    @cached_dataset("./nnattack/datasets/files/covtype.data")
     def covtype(auto_var, var_value, inter_var, n_samples):
         n_samples = int(n_samples)
 
@@ -178,6 +280,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var()
     @staticmethod
+    @cached_dataset("./nnattack/datasets/files/abalone.data")
     def abalone(auto_var, var_value, inter_var):
         # http://archive.ics.uci.edu/ml/datasets/Abalone
         data = np.genfromtxt('./nnattack/datasets/files/abalone.data', dtype='str', delimiter=',')
@@ -192,6 +295,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var(argument=r"digits(?P<n_dims>_pca\d+)?")
     @staticmethod
+    @cached_dataset()
     def digits(auto_var, var_value, inter_var, n_dims):
         from sklearn.datasets import load_digits
         X, y = load_digits(return_X_y=True)
@@ -206,6 +310,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var(argument=r"fullmnist(?P<n_dims>_pca\d+)?", shown_name="mnist")
     @staticmethod
+    @cached_dataset(*MNIST_FILES)
     def mnist(auto_var, inter_var, n_dims):
         from keras.datasets import mnist
 
@@ -230,6 +335,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var(argument=r"fullfashion(?P<n_dims>_pca\d+)?", shown_name="fashion")
     @staticmethod
+    @cached_dataset(*FASHION_MNIST_FILES)
     def fashion(auto_var, inter_var, n_dims):
         from keras.datasets import fashion_mnist
 
@@ -254,6 +360,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
 
     @register_var(argument=r"mnist17f(?P<n_dims>_pca\d+)?", shown_name="mnist17")
     @staticmethod
+    @cached_dataset(*MNIST_FILES)
     def mnist17f(auto_var, var_value, inter_var, n_dims):
         from keras.datasets import mnist
         from sklearn.decomposition import PCA
@@ -291,6 +398,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
     @register_var(argument=r"fashion_mnist35f(?P<n_dims>_pca\d+)?",
                   shown_name="f-mnist35")
     @staticmethod
+    @cached_dataset(*FASHION_MNIST_FILES)
     def fashion_mnist35f(auto_var, var_value, inter_var, n_dims):
         from keras.datasets import fashion_mnist
         from sklearn.decomposition import PCA
@@ -329,6 +437,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
     @register_var(argument=r"fashion_mnist06f(?P<n_dims>_pca\d+)?",
                   shown_name="f-mnist06")
     @staticmethod
+    @cached_dataset(*FASHION_MNIST_FILES)
     def fashion_mnist06f(auto_var, var_value, inter_var, n_dims):
         from keras.datasets import fashion_mnist
         from sklearn.decomposition import PCA
@@ -366,6 +475,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
     @register_var(argument=r"mnist17_(?P<n_samples>\d+)(?P<n_dims>_pca\d+)?",
                   shown_name="mnist17")
     @staticmethod
+    @cached_dataset(*MNIST_FILES)
     def mnist17(auto_var, var_value, inter_var, n_samples, n_dims):
         from keras.datasets import mnist
         from sklearn.decomposition import PCA
@@ -396,6 +506,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
     @register_var(argument=r"mnist35_(?P<n_samples>\d+)(?P<n_dims>_pca\d+)?",
                   shown_name="mnist35")
     @staticmethod
+    @cached_dataset(*MNIST_FILES)
     def mnist35(auto_var, var_value, inter_var, n_samples, n_dims):
         from keras.datasets import mnist
         from sklearn.decomposition import PCA
@@ -426,6 +537,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
     @register_var(argument=r"fashion_mnist06_(?P<n_samples>\d+)(?P<n_dims>_pca\d+)?",
                   shown_name="f-mnist06")
     @staticmethod
+    @cached_dataset(*FASHION_MNIST_FILES)
     def fashion_mnist06(auto_var, var_value, inter_var, n_samples, n_dims):
         from keras.datasets import fashion_mnist
         from sklearn.decomposition import PCA
@@ -458,6 +570,7 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
     @register_var(argument=r"fashion_mnist35_(?P<n_samples>\d+)(?P<n_dims>_pca\d+)?",
                   shown_name="f-mnist35")
     @staticmethod
+    @cached_dataset(*FASHION_MNIST_FILES)
     def fashion_mnist35(auto_var, var_value, inter_var, n_samples, n_dims):
         from keras.datasets import fashion_mnist
         from sklearn.decomposition import PCA
@@ -490,9 +603,11 @@ class DatasetVarClass(VariableClass, metaclass=RegisteringChoiceType):
     @register_var(argument=r"cifar-(?P<arch>[a-zA-Z0-9]+)(?P<n_dims>_pca\d+)?",
                   shown_name="cifar")
     @staticmethod
+    @cached_dataset(*CIFAR10_FILES, "./nnattack/datasets/cnn_feature.py")
     def cifar_resnet50(auto_var, var_value, inter_var, n_dims, arch):
         from keras.datasets import cifar10
         from sklearn.decomposition import PCA
+        from .cnn_feature import extract_feature
 
         n_dims = int(n_dims[4:]) if n_dims else None
 
@@ -1,19 +1,19 @@
 from functools import partial
 from copy import deepcopy
 
-import tensorflow as tf
 import numpy as np
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.model_selection import ParameterGrid, KFold
-from cleverhans.attacks import ProjectedGradientDescent
-from cleverhans.utils_keras import KerasModelWrapper
 
 from autovar import AutoVar
 from autovar.base import RegisteringChoiceType, VariableClass, register_var
 
+from ..tf_session import get_session
+
 
 def exp_fn(auto_var, trnX, valX, trny, valy, eps:float):
-    auto_var.set_intermidiate_variable('sess', tf.Session())
+    # a fresh session is created if the model asks for one
+    auto_var.inter_var.pop('sess', None)
     auto_var.set_intermidiate_variable("trnX", trnX)
     auto_var.set_intermidiate_variable("trny", trny)
     model = auto_var.get_var('model')
@@ -30,9 +30,10 @@ def cross_validation(auto_var: AutoVar, grid, valid_eps:float):
     y = auto_var.get_intermidiate_variable('trny')
 
     # TODO add clone method
-    sess = auto_var.inter_var.pop('sess')
+    sess = auto_var.inter_var.pop('sess', None)
     val_auto_var = deepcopy(auto_var)
-    auto_var.inter_var['sess'] = sess
+    if sess is not None:
+        auto_var.inter_var['sess'] = sess
     val_auto_var._read_only = False
     val_auto_var._no_hooks = True
 
@@ -187,7 +188,7 @@ class ModelVarClass(VariableClass, metaclass=RegisteringChoiceType):
         clf = KernelSubTFModel(
             c=c,
             lbl_enc=inter_var['lbl_enc'],
-            sess=inter_var['sess'],
+            sess=get_session(auto_var),
             train_type=train,
             eps=eps,
             ord=auto_var.get_var("ord"),
@@ -222,6 +223,38 @@ class ModelVarClass(VariableClass, metaclass=RegisteringChoiceType):
         from .robust_nn import Robust_1NN
         return Robust_1NN(Delta=0.45, delta=0.1, ord=auto_var.get_var("ord"))
 
+    @register_var(argument=r"approxAP(?P<index_type>flat|ivf|hnsw)(?P<n_probes>_p\d+)?_nn_k(?P<n_neighbors>\d+)_(?P<eps>\d+)")
+    @staticmethod
+    def approx_ap_faiss_nn(auto_var, var_value, inter_var, index_type, n_probes,
+            n_neighbors, eps):
+        """ Nearest Neighbor classifier with approximate adversarial pruning,
+        the eps neighborhoods come from a faiss range search (l2 only)
+        index_type:
+          flat: exact search
+          ivf: inverted lists
+          hnsw: hierarchical navigable small world graph
+        n_probes: ivf lists visited (nprobe) or hnsw candidates kept
+          (efSearch) per query, higher gives a higher recall
+        eps: defense strength """
+        from .adversarial_knn import AdversarialKnn
+        eps = int(eps) * 0.01
+        n_neighbors = int(n_neighbors)
+
+        solver_kwargs = {'index_type': index_type}
+        if n_probes is not None and index_type == 'ivf':
+            solver_kwargs['nprobe'] = int(n_probes[2:])
+        elif n_probes is not None and index_type == 'hnsw':
+            solver_kwargs['efSearch'] = int(n_probes[2:])
+
+        return AdversarialKnn(
+            n_neighbors=n_neighbors,
+            train_type='approxAP',
+            ord=auto_var.get_var("ord"),
+            eps=eps,
+            approx_ap_kwargs={'nn_solver': 'faiss', 'solver_kwargs': solver_kwargs,
+                              'random_state': auto_var.get_var("random_seed")},
+        )
+
     @register_var(argument=r"(?P<train>[a-zA-Z0-9]+_)?nn_k(?P<n_neighbors>\d+)_(?P<eps>\d+)")
     @staticmethod
     def adv_robustnn(auto_var, var_value, inter_var, n_neighbors, train, eps):
@@ -240,6 +273,9 @@ class ModelVarClass(VariableClass, metaclass=RegisteringChoiceType):
         attack_model = None
         if train == 'adv':
             attack_model = auto_var.get_var("attack")
+        approx_ap_kwargs = None
+        if train == 'approxAP':
+            approx_ap_kwargs = {'random_state': auto_var.get_var("random_seed")}
 
         return AdversarialKnn(
             n_neighbors=n_neighbors,
@@ -247,6 +283,7 @@ class ModelVarClass(VariableClass, metaclass=RegisteringChoiceType):
             attack_model=attack_model,
             ord=auto_var.get_var("ord"),
             eps=eps,
+            approx_ap_kwargs=approx_ap_kwargs,
         )
 
     @register_var(argument='knn(?P<n_neighbors>\d+)')
@@ -263,7 +300,7 @@ class ModelVarClass(VariableClass, metaclass=RegisteringChoiceType):
         clf = KernelSubTFModel(
             c=0.1,
             lbl_enc=inter_var['lbl_enc'],
-            sess=inter_var['sess'],
+            sess=get_session(auto_var),
             ord=auto_var.get_var("ord"),
         )
         return clf
@@ -341,7 +378,7 @@ class ModelVarClass(VariableClass, metaclass=RegisteringChoiceType):
             lbl_enc=inter_var['lbl_enc'],
             n_features=n_features,
             n_classes=n_classes,
-            sess=inter_var['sess'],
+            sess=get_session(auto_var),
             architecture='mlp',
             train_type=train,
             ord=auto_var.get_var("ord"),
@@ -366,7 +403,7 @@ class ModelVarClass(VariableClass, metaclass=RegisteringChoiceType):
             lbl_enc=inter_var['lbl_enc'],
             n_features=n_features,
             n_classes=n_classes,
-            sess=inter_var['sess'],
+            sess=get_session(auto_var),
             architecture='logistic_regression',
             train_type=train,
             ord=auto_var.get_var("ord"),
@@ -8,7 +8,7 @@ class AdversarialKnn(KNeighborsClassifier):
                 train_type:str=None, delta=0.1, Delta=0.45,
                 n_neighbors=5, weights='uniform', algorithm='auto',
                 leaf_size=30, p=2, metric='minkowski', metric_params=None,
-                n_jobs=1, eps:float = None):
+                n_jobs=1, eps:float = None, approx_ap_kwargs=None):
         """K Nearest Neighbors Classifier with defense
 
         Keyword Arguments:
@@ -19,6 +19,7 @@ class AdversarialKnn(KNeighborsClassifier):
             delta {float} -- parameter for Wang's 1-NN defense (default: {0.1})
             Delta {float} -- parameter for Wang's 1-NN defense (default: {0.45})
             eps {float} -- defense strength (default: {None})
+            approx_ap_kwargs {dict} -- keyword arguments of approx_ap when `train_type` is 'approxAP' (default: {None})
 
         Other Arguments follows the original scikit-learn argument (sklearn.neighbors.KNeighborsClassifier).
         """
@@ -27,6 +28,7 @@ class AdversarialKnn(KNeighborsClassifier):
         self.ord = ord
         self.attack_model = attack_model
         self.eps = eps
+        self.approx_ap_kwargs = approx_ap_kwargs
 
         self.train_type = train_type
         self.delta = delta
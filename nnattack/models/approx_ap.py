@@ -5,59 +5,157 @@ from __future__ import division
 import logging
 
 import faiss
-import networkx as nx
-from networkx.algorithms.approximation.vertex_cover import min_weighted_vertex_cover
 import numpy as np
+from joblib import Parallel
 from sklearn.neighbors import NearestNeighbors
 from sklearn.cluster import KMeans
 from scipy.spatial.distance import cdist
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, triu
+
+from ..budget import get_n_jobs, budgeted_delayed
 
 logger = logging.getLogger(__name__)
 
-def approx_ap(X, y, eps, sep_measure, nn_solver="exact", solver_kwargs=None,
-        kmeans_clusters: int = 1):
+def faiss_radius_neighbors_graph(X, eps, index_type="flat", nlist=None,
+        nprobe=8, M=32, efSearch=64):
+    """Neighbors within l2 distance eps of every point from a faiss range
+    search, as a CSR connectivity matrix.
+
+    Arguments:
+        X {ndarray, shape=(n_samples, n_features)} -- the points
+        eps {float} -- radius of the neighborhoods
+
+    Keyword Arguments:
+        index_type {str} -- 'flat' for an exact search, 'ivf' or 'hnsw' for an approximate one (default: {"flat"})
+        nlist {int} -- number of ivf lists, 4 * sqrt(n_samples) if None (default: {None})
+        nprobe {int} -- number of ivf lists visited per query, more for a higher recall (default: {8})
+        M {int} -- number of neighbors of a hnsw node (default: {32})
+        efSearch {int} -- number of hnsw candidates kept per query, more for a higher recall (default: {64})
+
+    Returns:
+        csr_matrix -- symmetric connectivity matrix of shape (n_samples, n_samples)
+    """
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    n, d = X.shape
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(d)
+    elif index_type == "ivf":
+        if nlist is None:
+            nlist = max(1, int(4 * np.sqrt(n)))
+        quantizer = faiss.IndexFlatL2(d)
+        index = faiss.IndexIVFFlat(quantizer, d, min(nlist, n))
+        index.train(X)
+        index.nprobe = nprobe
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, M)
+        index.hnsw.efSearch = efSearch
+    else:
+        raise ValueError(f"Not supported faiss index_type, {index_type}")
+    index.add(X)
+
+    # faiss returns the squared distances strictly below the radius
+    radius = np.nextafter(np.float32(eps) ** 2, np.float32(np.inf))
+    lims, _, I = index.range_search(X, float(radius))
+    graph = csr_matrix((np.ones(len(I), dtype=np.int8), I.astype(np.intp), lims),
+                       shape=(n, n))
+    # an approximate search may find a pair from one end only
+    return graph.maximum(graph.T).tocsr()
+
+def collision_edges(X, y, eps, sep_measure, nn_solver="exact", solver_kwargs=None):
+    """Edges (i, j), i < j, between the points of different labels within
+    distance eps, from the radius neighbors of every point as a CSR matrix.
+
+    nn_solver is "exact" for sklearn or "faiss" (l2 only), solver_kwargs
+    are passed to faiss_radius_neighbors_graph.
+    """
+    if nn_solver == "exact":
+        nn = NearestNeighbors(n_jobs=get_n_jobs(-1), p=sep_measure).fit(X)
+        graph = nn.radius_neighbors_graph(X, radius=eps, mode='connectivity')
+    elif nn_solver == "faiss":
+        if sep_measure != 2:
+            raise ValueError(f"faiss range search only supports l2, got {sep_measure}")
+        graph = faiss_radius_neighbors_graph(X, eps, **(solver_kwargs or {}))
+    else:
+        raise ValueError(f"Not supported nn_solver, {nn_solver}")
+
+    graph = triu(graph, k=1).tocoo()
+    diff = (y[graph.row] != y[graph.col])
+    return graph.row[diff], graph.col[diff]
+
+def maximal_matching_cover(n, rows, cols, random_state=0):
+    """2-approximate minimum vertex cover, both ends of a maximal matching.
+
+    The matching is built in rounds, every remaining edge gets a random
+    priority and the edges with the lowest priority at both of their ends
+    are matched, then the edges touching a matched vertex are dropped.
+
+    Arguments:
+        n {int} -- number of vertices
+        rows {ndarray} -- first end of each edge
+        cols {ndarray} -- second end of each edge
+
+    Keyword Arguments:
+        random_state {int or RandomState} -- random state of the priorities, fixed so the cover is reproducible (default: {0})
+
+    Returns:
+        ndarray -- boolean mask of the vertices in the cover
+    """
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+    covered = np.zeros(n, dtype=bool)
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    while len(rows) > 0:
+        priority = random_state.permutation(len(rows))
+        best = np.full(n, len(rows))
+        np.minimum.at(best, rows, priority)
+        np.minimum.at(best, cols, priority)
+        matched = np.logical_and(best[rows] == priority, best[cols] == priority)
+        covered[rows[matched]] = True
+        covered[cols[matched]] = True
+        keep = ~np.logical_or(covered[rows], covered[cols])
+        rows, cols = rows[keep], cols[keep]
+    return covered
+
+def _prune(X, y, eps, sep_measure, nn_solver, solver_kwargs, random_state):
+    """Indices of the points kept after removing the vertex cover."""
+    logger.info("solving %s", X.shape)
+    rows, cols = collision_edges(X, y, eps, sep_measure, nn_solver, solver_kwargs)
+    covered = maximal_matching_cover(len(X), rows, cols, random_state=random_state)
+    return np.where(~covered)[0]
+
+def approx_ap_indices(X, y, eps, sep_measure, nn_solver="exact", solver_kwargs=None,
+        kmeans_clusters: int = 1, n_jobs: int = -1, random_state=0):
+    """Indices of the points kept by approx_ap, in the order it returns them.
+    The cover depends on random_state, the same seed keeps the same points."""
     if isinstance(X, csr_matrix):
         X = X.toarray()
-
-    ori_shape = list(X.shape)
+    if not isinstance(random_state, np.random.RandomState):
+        random_state = np.random.RandomState(random_state)
+    y = np.asarray(y)
     X = X.reshape((len(X), -1))
 
     if kmeans_clusters > 1 :
-        kmeans = KMeans(n_clusters=kmeans_clusters, n_jobs=10).fit(X)
+        kmeans = KMeans(n_clusters=kmeans_clusters, n_jobs=get_n_jobs(10)).fit(X)
         kmeans_ind = kmeans.labels_
     else:
         kmeans_ind = np.zeros_like(y)
 
+    # the clusters are independent, each is solved in its own process
+    inv_indexs = [np.where(kmeans_ind == i)[0] for i in range(kmeans_clusters)]
+    seeds = random_state.randint(np.iinfo(np.int32).max, size=kmeans_clusters)
+    n_jobs = get_n_jobs(n_jobs) if kmeans_clusters > 1 else 1
+    kept = Parallel(n_jobs=n_jobs)(
+        budgeted_delayed(_prune, n_jobs)(X[inv], y[inv], eps, sep_measure,
+                                         nn_solver, solver_kwargs, seed)
+        for inv, seed in zip(inv_indexs, seeds))
+    return np.concatenate(
+        [inv[idx] for inv, idx in zip(inv_indexs, kept)]).astype(int)
 
-    final_idx = []
-    inv_indexs = []
-    for i in range(kmeans_clusters):
-        inv_indexs.append(np.where(kmeans_ind == i)[0])
-        tempX = X[inv_indexs[-1]]
-        print(f"solving {tempX.shape}")
-
-        if nn_solver == "exact":
-            nn = NearestNeighbors(n_jobs=-1, p=sep_measure).fit(tempX)
-            ind = nn.radius_neighbors(tempX, radius=eps, return_distance=False)
-        #elif nn_solver == "faiss":
-        #    index = faiss.IndexLSH(d, solver_kwargs['n_bits'])
-        #    index.add(X)
-        #    _, ind = self.index.search(X, )
-        else:
-            raise ValueError(f"Not supported nn_solver, {nn_solver}")
-
-        G = nx.Graph()
-        G.add_nodes_from(list(range(len(tempX))))
-        for i in range(len(tempX)):
-            for j in ind[i]:
-                if y[i] != y[j]:
-                    G.add_edge(i, j)
-        idx = min_weighted_vertex_cover(G)
-        idx = list(set(range(len(tempX))) - idx)
-
-        final_idx += list(inv_indexs[-1][idx])
-
-    X = X.reshape([len(X)] + ori_shape[1:])
-
-    return X[final_idx], y[final_idx]
+def approx_ap(X, y, eps, sep_measure, nn_solver="exact", solver_kwargs=None,
+        kmeans_clusters: int = 1, n_jobs: int = -1, random_state=0):
+    if isinstance(X, csr_matrix):
+        X = X.toarray()
+    final_idx = approx_ap_indices(X, y, eps, sep_measure, nn_solver=nn_solver,
+            solver_kwargs=solver_kwargs, kmeans_clusters=kmeans_clusters,
+            n_jobs=n_jobs, random_state=random_state)
+    return X[final_idx], np.asarray(y)[final_idx]
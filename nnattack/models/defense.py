@@ -2,68 +2,88 @@
 Download from https://raw.githubusercontent.com/EricYizhenWang/robust_nn_icml/master/robust_1nn.py
 """
 from __future__ import division
+import logging
 
 import numpy as np
 from sklearn.neighbors import NearestNeighbors, KNeighborsClassifier
-from scipy.spatial.distance import cdist
 
-from .robust_nn.eps_separation import find_eps_separated_set
+from .robust_nn.eps_separation import find_eps_separated_indices, find_close_to_other_label
+from ..cache import DiskCache, hash_key, source_digest
 from ..variables import auto_var
-from .approx_ap import approx_ap
+from .approx_ap import approx_ap_indices
+
+logger = logging.getLogger(__name__)
+
+# kept indices of the pruning defenses, keyed by the data, the parameters
+# and the sources of nnattack.models
+PRUNING_CACHE = DiskCache('pruning')
 
 def find_confident_label(X, Y, k, Delta):
     thres = 2*Delta
-    neigh = NearestNeighbors(k)
+    neigh = NearestNeighbors(n_neighbors=k)
     neigh.fit(X)
     nn = neigh.kneighbors(X, k, return_distance=False)
-    Y_hat = np.array([[Y[j] for j in i] for i in nn])
-    Y_hat = np.sum(Y_hat, axis=1)/k
-    Y_hat = [0 if (abs(Y_hat[i]) < thres) else np.sign(Y_hat[i])
-             for i in range(X.shape[0])]
-    Y_hat = np.array(Y_hat)
+    Y_hat = np.asarray(Y)[nn].sum(axis=1) / k
+    Y_hat = np.where(np.abs(Y_hat) < thres, 0, np.sign(Y_hat))
     return Y_hat
 
-def find_red_points(X, Y, Y_hat, eps, ord):
-    n = X.shape[0]
-    d = cdist(X, X, 'minkowski', ord)
-
-    is_close = (d < eps)
-    is_red = np.ones((n, 1))
-    for i in range(n):
-        for j in range(n):
-            if (is_close[i, j]) and (Y_hat[i] != Y_hat[j]):
-                is_red[i] = 0
-
-            if Y_hat[i] != Y[i]:
-                is_red[i] = 0
-    red_pts = [np.array([X[i] for i in range(n) if is_red[i]]),
-               np.array([Y[i] for i in range(n) if is_red[i]])]
-    other_pts = [np.array([X[i] for i in range(n) if not is_red[i]]),
-                 np.array([Y[i] for i in range(n) if not is_red[i]])]
+def find_red_points(X, Y, Y_hat, eps, ord, block_size=None):
+    Y, Y_hat = np.asarray(Y), np.asarray(Y_hat)
+    is_red = np.logical_and(
+            ~find_close_to_other_label(X, Y_hat, eps, ord, block_size=block_size),
+            Y_hat == Y)
+    red_pts = [X[is_red], Y[is_red]]
+    other_pts = [X[~is_red], Y[~is_red]]
 
     [X_red, Y_red] = [red_pts[0], red_pts[1]]
     [X_other, Y_other] = [other_pts[0], other_pts[1]]
     return X_red, Y_red, X_other, Y_other
 
 def get_aug_v2(X, Y, Delta, delta, eps, ord):
+    idx = get_aug_v2_indices(X, Y, Delta, delta, eps, ord)
+    return X[idx], np.asarray(Y)[idx]
+
+def get_aug_v2_indices(X, Y, Delta, delta, eps, ord):
+    """Indices of the points kept by get_aug_v2, in the order it returns them."""
+    Y = np.asarray(Y)
     k = min(int(3*np.log(X.shape[0]/delta)/(np.log(2)*(Delta**2))), len(X))
 
     Y_hat = find_confident_label(X, Y, k, Delta)
-    X_red, Y_red, X_other, Y_other = find_red_points(
-            X, Y, eps=eps, Y_hat=Y_hat, ord=ord)
-
-    print("X_red: ", X_red.shape)
-    [X, Y] = [X_other, Y_other]
-    print("X_other: ", X.shape)
-    X, Y = find_eps_separated_set(X, eps/2, Y, ord=ord)
-
-    if X_red.shape[0] > 0:
-        X_train = np.concatenate([X, X_red])
-        Y_train = np.concatenate([Y, Y_red])
+    is_red = np.logical_and(~find_close_to_other_label(X, Y_hat, eps, ord), Y_hat == Y)
+    red_idx, other_idx = np.where(is_red)[0], np.where(~is_red)[0]
+    logger.info("X_red: %d, X_other: %d", len(red_idx), len(other_idx))
+    keep = find_eps_separated_indices(X[other_idx], eps/2, Y[other_idx], ord=ord)
+    return np.concatenate((other_idx[keep], red_idx))
+
+def get_pruned_indices(model, X, y, eps, sep_measure):
+    """Indices of the points kept by the pruning defense model.train_type,
+    read from PRUNING_CACHE when the same data was pruned the same way."""
+    train_type = model.train_type
+    if train_type == 'approxAP':
+        approx_ap_kwargs = getattr(model, 'approx_ap_kwargs', None) or {}
+        # the cover depends on the seed, 0 is the default of approx_ap
+        params = dict({'random_state': 0}, **approx_ap_kwargs)
+        fn = lambda: approx_ap_indices(X, y, eps, sep_measure, **approx_ap_kwargs)
+    elif train_type in ['advPruning', 'advPruningmin']:
+        if len(np.unique(y)) != 2:
+            raise ValueError("Can only deal with number of classes = 2"
+                             "got %d", len(np.unique(y)))
+        measure = 'min_measure' if train_type == 'advPruningmin' else sep_measure
+        params = None
+        fn = lambda: find_eps_separated_indices(X, eps/2, y.astype(int)*2-1, measure)
+    elif train_type == 'robustv2':
+        if len(np.unique(y)) != 2:
+            raise ValueError("Can only deal with number of classes = 2"
+                             "got %d", len(np.unique(y)))
+        params = [model.Delta, model.delta]
+        fn = lambda: get_aug_v2_indices(X, y.astype(int)*2-1, model.Delta,
+                                        model.delta, eps, sep_measure)
     else:
-        X_train = X
-        Y_train = Y
-    return X_train, Y_train
+        raise ValueError("Not a pruning training type %s", train_type)
+
+    key = hash_key(np.asarray(X), np.asarray(y), train_type, eps, sep_measure, params,
+                   source_digest('models'))
+    return PRUNING_CACHE.get_or_compute(key, fn)
 
 def get_aug_data(model, X, y, eps, sep_measure=None):
     """Augment the data for defense, returns the augmented data
@@ -73,6 +93,7 @@ def get_aug_data(model, X, y, eps, sep_measure=None):
             model.train_type == 'adv': adversarial training
             model.train_type == 'robustv2': adversarial pruning
             model.train_type == 'advPruning': Wang's defense for 1-NN
+            model.train_type == 'approxAP': approximate adversarial pruning, model.approx_ap_kwargs (if any) are passed to approx_ap
             model.train_type is None: Do nothing returns the original data
         X {ndarray, dim=2} -- feature vectors
         y {ndarray, dim=1} -- labels
@@ -122,35 +143,9 @@ def get_aug_data(model, X, y, eps, sep_measure=None):
             auto_var.set_intermidiate_variable("trny", y)
         augX, augy = X, y
 
-    elif model.train_type == 'advPruningmin':
-        if len(np.unique(y)) != 2:
-            raise ValueError("Can only deal with number of classes = 2"
-                             "got %d", len(np.unique(y)))
-        y = y.astype(int)*2-1
-        augX, augy = find_eps_separated_set(X, eps/2, y, 'min_measure')
-        augy = (augy+1)//2
-
-    elif model.train_type == 'approxAP':
-        augX, augy = approx_ap(X, y, eps, sep_measure)
-
-    elif model.train_type == 'advPruning':
-        if len(np.unique(y)) != 2:
-            raise ValueError("Can only deal with number of classes = 2"
-                             "got %d", len(np.unique(y)))
-        y = y.astype(int)*2-1
-        augX, augy = find_eps_separated_set(X, eps/2, y, ord=sep_measure)
-        augy = (augy+1)//2
-
-    elif model.train_type == 'robustv2':
-        if len(np.unique(y)) != 2:
-            raise ValueError("Can only deal with number of classes = 2"
-                             "got %d", len(np.unique(y)))
-        y = y.astype(int)*2-1
-
-        Delta = model.Delta
-        delta = model.delta
-        augX, augy = get_aug_v2(X, y, Delta, delta, eps, sep_measure)
-        augy = (augy+1)//2
+    elif model.train_type in ['advPruningmin', 'approxAP', 'advPruning', 'robustv2']:
+        idx = get_pruned_indices(model, X, y, eps, sep_measure)
+        augX, augy = X[idx], y[idx]
 
     elif model.train_type is None:
         augX, augy = X, y
@@ -44,6 +44,19 @@ class FaissLSHModel(BaseEstimator):
         query = self.trny[I.reshape(-1)].reshape((len(X), self.n_neighbors))
         return stats.mode(query, axis=1)[0].ravel()
 
+    def __getstate__(self):
+        # faiss indexes are pickled through their serialized bytes
+        state = super().__getstate__()
+        if 'index' in state:
+            state = dict(state, index=faiss.serialize_index(self.index))
+        return state
+
+    def __setstate__(self, state):
+        if 'index' in state:
+            state = dict(state, index=faiss.deserialize_index(
+                np.ascontiguousarray(state['index'])))
+        super().__setstate__(state)
+
     def save(self, file_path: str):
         faiss.write_index(self.index, file_path)
 
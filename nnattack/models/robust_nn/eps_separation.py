@@ -1,49 +1,185 @@
 import numpy as np
+import scipy.sparse as sp
+from scipy.spatial.distance import cdist
+from sklearn.neighbors import KDTree
 
-from .hopcroftkarp import HopcroftKarp
+# number of float64 entries of the (block, n_samples, n_features) difference
+# array of the 'min_measure' collision search and of the (block, n_samples)
+# distance blocks
+MAX_BATCH_ELEMENTS = 2**24
+
+def _collision_pairs(eps, pts, y, ord):
+    """Pairs (i, j), i < j, of points with different labels at distance at
+    most 2*eps, and their distances."""
+    pts = np.asarray(pts, dtype=np.float64).reshape((len(pts), -1))
+    y = np.asarray(y)
+    n = len(pts)
+    rows, cols, dists = [], [], []
+    if ord in [1, 2, np.inf]:
+        metric = {1: 'manhattan', 2: 'euclidean', np.inf: 'chebyshev'}[ord]
+        labels = np.unique(y)
+        for c in labels[:-1]:
+            # points of class c against the points of the classes after it
+            ind = np.where(y == c)[0]
+            others = np.where(y > c)[0]
+            if len(others) == 0:
+                continue
+            tree = KDTree(pts[ind], metric=metric)
+            neighbors, dist = tree.query_radius(pts[others], r=2*eps,
+                                                return_distance=True)
+            counts = np.array([len(nb) for nb in neighbors], dtype=np.intp)
+            if counts.sum() == 0:
+                continue
+            rows.append(ind[np.concatenate(neighbors)])
+            cols.append(np.repeat(others, counts))
+            dists.append(np.concatenate(dist))
+    elif ord == 'min_measure':
+        # min_k (pts[i, k] - pts[j, k]) for i < j, not symmetric
+        batch_size = max(1, MAX_BATCH_ELEMENTS // max(1, pts.size))
+        for start in range(0, n, batch_size):
+            idx = np.arange(start, min(n, start + batch_size))
+            dist = (pts[idx, np.newaxis] - pts[np.newaxis]).min(axis=2)
+            hit = np.logical_and(dist <= 2*eps, y[idx, np.newaxis] != y[np.newaxis])
+            hit &= idx[:, np.newaxis] < np.arange(n)[np.newaxis]
+            i, j = np.nonzero(hit)
+            rows.append(idx[i])
+            cols.append(j)
+            dists.append(dist[i, j])
+    else:
+        raise ValueError("Not supported measure %s for collision" % str(ord))
+
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return np.minimum(rows, cols), np.maximum(rows, cols), np.concatenate(dists)
+
+def find_close_to_other_label(X, labels, eps, ord, block_size=None):
+    '''
+        Whether each point is at distance less than eps of a point with
+        another label. The distances are computed block_size rows at a
+        time, so the memory stays O(block_size * n).
+
+        block_size: number of rows of each distance block, by default as
+            many as fit in MAX_BATCH_ELEMENTS.
+    '''
+    X = np.asarray(X).reshape((len(X), -1))
+    labels = np.asarray(labels)
+    n = len(X)
+    if block_size is None:
+        block_size = max(1, MAX_BATCH_ELEMENTS // max(1, n))
+    is_close = np.zeros(n, dtype=bool)
+    for c in np.unique(labels):
+        rows = np.where(labels == c)[0]
+        others = X[labels != c]
+        if len(others) == 0:
+            continue
+        for start in range(0, len(rows), block_size):
+            idx = rows[start:start+block_size]
+            d = cdist(X[idx], others, 'minkowski', p=ord)
+            is_close[idx] = (d < eps).any(axis=1)
+    return is_close
 
 def build_collision_graph(eps, pts, y, ord):
     '''
         This function builds the collision/conflict graph for the max-matching algorithm.
+        Two points collide if their labels differ and their distance is at
+        most 2*eps, found with a radius query on a KDTree.
+
+        Output:
+            adj: symmetric scipy.sparse.csr_matrix adjacency of shape (n, n)
     '''
-    n = len(pts)
-    graph = dict()
-    
-    adj_lst = dict()
-    for i in range(n):
-        adj_lst[i] = set([])
-    
-    for i in range(n-1):
-        for j in range(i+1, n):
-            if y[i] != y[j]:
-                p1 = pts[i]
-                p2 = pts[j]
-                d = p1 - p2
-                if ord in [1, 2, np.inf]:
-                    dist = np.linalg.norm(d, ord=ord)
-                elif ord == 'min_measure':
-                    dist = min(d)
-                else:
-                    raise ValueError("Not supported measure %s for collision",
-                                     str(ord))
-                if (dist <= 2*eps):
-                    adj_lst[i].add(j)
-                    adj_lst[j].add(i)
-                    if y[i] == 1:
-                        if i in graph:
-                            graph[i].add(j)
-                        else: 
-                            graph[i] = set([j])
-                    else:
-                        if j in graph:
-                            graph[j].add(i)
-                        else:
-                            graph[j] = set([i])
+    i, j, _ = _collision_pairs(eps, pts, y, ord)
     #print 'Done: find collision graph'
-    return [adj_lst, graph]
+    return _pairs_to_adjacency(i, j, len(pts))
+
+def _pairs_to_adjacency(i, j, n):
+    data = np.ones(2 * len(i), dtype=np.int8)
+    adj = sp.csr_matrix((data, (np.concatenate((i, j)), np.concatenate((j, i)))),
+                        shape=(n, n))
+    adj.sort_indices()
+    return adj
 
-def find_matching(graph):
-    match = HopcroftKarp(graph).maximum_matching()
+def _gather_neighbors(adj, rows):
+    """Concatenated CSR rows of adj, the neighbors of every vertex of rows."""
+    starts = adj.indptr[rows]
+    counts = adj.indptr[rows + 1] - starts
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return adj.indices[np.repeat(starts, counts) + offsets]
+
+def find_matching(adj, left, init_match=None):
+    '''
+        Maximum matching of the bipartite graph adj between the vertices in
+        left and the others, by Hopcroft-Karp on the CSR arrays. The
+        breadth first layering is vectorized, the augmenting paths are
+        searched with an explicit stack.
+
+        adj: symmetric csr adjacency matrix, every edge joins left to right.
+        left: boolean array, the left side of the graph.
+        init_match: a matching of adj to augment, in the output format.
+
+        Output:
+            match: partner of every vertex, -1 if it is unmatched.
+    '''
+    indptr, indices = adj.indptr, adj.indices
+    n = adj.shape[0]
+    left = np.asarray(left, dtype=bool)
+    if init_match is None:
+        match = -np.ones(n, dtype=np.intp)
+    else:
+        match = np.array(init_match, dtype=np.intp)
+    left_ids = np.where(np.logical_and(left, np.diff(indptr) > 0))[0]
+    # python lists, the path search below goes one vertex at a time
+    indptr_l, indices_l = indptr.tolist(), indices.tolist()
+
+    while True:
+        # layers of left vertices from the free ones, alternating paths
+        dist = -np.ones(n, dtype=np.intp)
+        frontier = left_ids[match[left_ids] == -1]
+        dist[frontier] = 0
+        found = False
+        while len(frontier) > 0 and not found:
+            nbrs = np.unique(_gather_neighbors(adj, frontier))
+            found = np.any(match[nbrs] == -1)
+            nxt = match[nbrs]
+            nxt = nxt[nxt != -1]
+            nxt = nxt[dist[nxt] == -1]
+            dist[nxt] = dist[frontier[0]] + 1
+            frontier = nxt
+        if not found:
+            break
+
+        # vertex disjoint shortest augmenting paths
+        roots = left_ids[np.logical_and(match[left_ids] == -1, dist[left_ids] == 0)]
+        ptr = indptr_l[:-1]
+        dist, match_l = dist.tolist(), match.tolist()
+        n_augmented = 0
+        for root in roots.tolist():
+            stack, via = [root], []
+            while stack:
+                u = stack[-1]
+                if ptr[u] == indptr_l[u+1]:
+                    # dead end for the rest of the phase
+                    dist[u] = -1
+                    stack.pop()
+                    if via:
+                        via.pop()
+                    continue
+                v = indices_l[ptr[u]]
+                ptr[u] += 1
+                w = match_l[v]
+                if w == -1:
+                    via.append(v)
+                    for a, b in zip(stack, via):
+                        match_l[a] = b
+                        match_l[b] = a
+                    n_augmented += 1
+                    break
+                elif dist[w] == dist[u] + 1:
+                    stack.append(w)
+                    via.append(v)
+        match = np.array(match_l, dtype=np.intp)
+        if n_augmented == 0:
+            break
     #print 'Done: find matching'
     return match
 
@@ -51,75 +187,93 @@ def find_num_collision(eps, pts, y, ord):
     '''
         This function finds the number of collision/conflicts of each vertex. 
         Output:
-            hasCollision: the set of vertices that has collision with other vertex
+            hasCollision: indices of the vertices that has collision with other vertex
             numCollision: number of collisions that each vertex has.
     '''
-    n = len(pts)
-    numCollision = [0 for i in range(n)]
-    hasCollision = set([])
-    for i in range(n-1):
-        for j in range(i+1, n):
-            if y[i] != y[j]:
-                p1 = pts[i]
-                p2 = pts[j]
-                d = p1 - p2
-                if ord in [1, 2, np.inf]:
-                    dist = np.linalg.norm(d, ord=ord)
-                elif ord == 'min_measure':
-                    dist = min(d)
-                else:
-                    raise ValueError("Not supported measure %s for collision",
-                                     str(ord))
-                if (dist <= (2*eps)):
-                    numCollision[i] += 1
-                    numCollision[j] += 1
-                    hasCollision.add(i)
-                    hasCollision.add(j)
+    adj = build_collision_graph(eps, pts, y, ord)
+    numCollision = np.diff(adj.indptr)
+    hasCollision = np.where(numCollision > 0)[0]
     return [hasCollision, numCollision]
 
-def find_Z(graph, matching, U, adj_lst):
-    # a simple bfs finding Z, set of vertices reachable from U via alternating path.
-    visited_via_matched_edge = set([p for p in U])
-    visited_via_unmatched_edge = set([p for p in U])
-    while True:
-        set1 = set([item for item in visited_via_unmatched_edge])
-        set2 = set([item for item in visited_via_matched_edge])
-        for u in visited_via_matched_edge:
-            if u in matching:
-                for v in adj_lst[u]:
-                    if v != matching[u]:
-                        set1.add(v)
-            else:
-                for v in adj_lst[u]:
-                    set1.add(v)
-                    
-        for u in visited_via_unmatched_edge:
-            if u in matching:
-                for v in adj_lst[u]:
-                    if v == matching[u]:
-                        set2.add(v)
-                        
-        if (len(set1) == len(visited_via_unmatched_edge)) and (len(set2) == len(visited_via_matched_edge)):
-            return set1.union(set2)
-        
-        visited_via_matched_edge = set2
-        visited_via_unmatched_edge = set1
-
-def find_min_cover(graph, adj_lst, y_pts):
-    '''
-        This function finds the min-cover of a bipartite graph from max-matching.
-        graph: the collision graph dictionary, each key is a vertex while the value is the set of vertices adjacent to it. Note than a vertex can only appear in either the key or the value list,never both.
-        adj_lst: similar to graph, except that the key set contains all vertices.
-        has_collison: the set of points that has collision with other points
+def find_Z(adj, match, U):
+    '''
+        Vertices reachable from U via alternating paths, left to right by
+        any edge and right to left by the matched edge, by a breadth first
+        search on the CSR arrays.
+    '''
+    Z = np.zeros(adj.shape[0], dtype=bool)
+    frontier = np.asarray(U, dtype=np.intp)
+    Z[frontier] = True
+    while len(frontier) > 0:
+        nbrs = _gather_neighbors(adj, frontier)
+        nbrs = np.unique(nbrs[~Z[nbrs]])
+        Z[nbrs] = True
+        frontier = match[nbrs]
+        frontier = frontier[frontier != -1]
+        frontier = frontier[~Z[frontier]]
+        Z[frontier] = True
+    return Z
+
+def find_min_cover(adj, y_pts, init_match=None):
+    '''
+        This function finds the min-cover of a bipartite graph from max-matching,
+        by Konig's theorem.
+        adj: the collision graph as a symmetric csr adjacency matrix, positive and non-positive points are the two sides.
         y_pts: label of points in the graph. 
+        init_match: a matching of adj to start the max-matching from.
+
+        Output:
+            match: partner of every vertex in the max-matching, -1 if unmatched
+            K: indices of the vertices in the min-cover
     ''' 
-    matching = find_matching(graph)
-    L = set([i for i in graph if y_pts[i] > 0])
-    R = set([i for i in graph if y_pts[i] <= 0])
-    U = set([i for i in graph if (i not in matching) and (i in L)])
-    Z = find_Z(graph, matching, U, adj_lst)
-    K = (L.difference(Z)).union(R.intersection(Z))
-    return [matching, K]
+    y_pts = np.asarray(y_pts)
+    has_collision = np.diff(adj.indptr) > 0
+    L = np.logical_and(has_collision, y_pts > 0)
+    R = np.logical_and(has_collision, y_pts <= 0)
+    match = find_matching(adj, L, init_match=init_match)
+    U = np.where(np.logical_and(L, match == -1))[0]
+    Z = find_Z(adj, match, U)
+    K = np.where(np.logical_or(np.logical_and(L, ~Z), np.logical_and(R, Z)))[0]
+    return [match, K]
+
+def find_eps_separated_indices(pts, eps, y_pts, ord):
+    '''
+        Indices, ascending, of the epsilon-separated subset with the largest
+        cardinality, see find_eps_separated_set.
+    '''
+    return find_eps_separated_indices_multi(pts, [eps], y_pts, ord)[0]
+
+def find_eps_separated_indices_multi(pts, eps_list, y_pts, ord):
+    '''
+        find_eps_separated_indices for every eps of eps_list in one pass.
+
+        The collision graph is built once at the largest eps with the
+        distance of every edge, the graph of a smaller eps keeps the edges
+        within 2*eps. The graphs grow with eps, so going up the eps the
+        max-matching starts from the one of the previous eps, which is
+        still a matching.
+
+        Output:
+            list of the kept indices, ascending, for each eps of eps_list
+    '''
+    y_pts = [1 if i>0 else -1 for i in y_pts]
+    n = len(pts)
+    ret = [None] * len(eps_list)
+    if len(eps_list) == 0:
+        return ret
+    order = np.argsort(eps_list)
+    i, j, dist = _collision_pairs(eps_list[order[-1]], pts, y_pts, ord)
+
+    match = None
+    for k in order:
+        if k == order[-1]:
+            adj = _pairs_to_adjacency(i, j, n)
+        else:
+            keep = dist <= 2*eps_list[k]
+            adj = _pairs_to_adjacency(i[keep], j[keep], n)
+        match, min_cover = find_min_cover(adj, y_pts, init_match=match)
+        ret[k] = np.delete(np.arange(n), min_cover)
+    return ret
 
 def find_eps_separated_set(pts, eps, y_pts, ord):
     '''
@@ -139,11 +293,8 @@ def find_eps_separated_set(pts, eps, y_pts, ord):
             3) find the min-cover of the adjacency graph
             4) remove the min-cover from the original set pts.
     '''
-    y_pts = [1 if i>0 else -1 for i in y_pts]
     #hasCollision, numCollision = find_num_collision(eps, pts, y_pts,)
-    adj_lst, graph = build_collision_graph(eps, pts, y_pts, ord)
-    matching, min_cover = find_min_cover(graph, adj_lst, y_pts)
-    good_pts = np.delete(pts, list(min_cover), axis = 0)
-    good_y = np.delete(y_pts, list(min_cover), axis = 0)
-    #print('size of min_cover is: ', len(min_cover), 'size of matching is: ', len(matching))
+    idx = find_eps_separated_indices(pts, eps, y_pts, ord)
+    good_pts = np.asarray(pts)[idx]
+    good_y = np.array([1 if i>0 else -1 for i in y_pts])[idx]
     return good_pts, good_y
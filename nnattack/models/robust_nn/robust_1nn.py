@@ -6,40 +6,26 @@ Download from https://raw.githubusercontent.com/EricYizhenWang/robust_nn_icml/ma
 from __future__ import division
 import numpy as np
 from sklearn.neighbors import NearestNeighbors, KNeighborsClassifier
-from scipy.spatial.distance import cdist
 
-from .eps_separation import find_eps_separated_set
+from .eps_separation import find_eps_separated_set, find_close_to_other_label
 
 def find_confident_label(X, Y, k, Delta):
     thres = 2*Delta
     #print(thres, k)
-    neigh = NearestNeighbors(k)
+    neigh = NearestNeighbors(n_neighbors=k)
     neigh.fit(X)
     nn = neigh.kneighbors(X, k, return_distance=False)
-    Y_hat = np.array([[Y[j] for j in i] for i in nn])
-    Y_hat = np.sum(Y_hat, axis=1)/k
-    Y_hat = [0 if (abs(Y_hat[i]) < thres) else np.sign(Y_hat[i])
-             for i in range(X.shape[0])]
-    Y_hat = np.array(Y_hat)
+    Y_hat = np.asarray(Y)[nn].sum(axis=1) / k
+    Y_hat = np.where(np.abs(Y_hat) < thres, 0, np.sign(Y_hat))
     return Y_hat
 
-def find_red_points(X, Y, Y_hat, eps, ord):
-    n = X.shape[0]
-    d = cdist(X, X, 'minkowski', ord)
-
-    is_close = (d < eps)
-    is_red = np.ones((n, 1))
-    for i in range(n):
-        for j in range(n):
-            if (is_close[i, j]) and (Y_hat[i] != Y_hat[j]):
-                is_red[i] = 0
-
-            if Y_hat[i] != Y[i]:
-                is_red[i] = 0
-    red_pts = [np.array([X[i] for i in range(n) if is_red[i]]),
-               np.array([Y[i] for i in range(n) if is_red[i]])]
-    other_pts = [np.array([X[i] for i in range(n) if not is_red[i]]),
-                 np.array([Y[i] for i in range(n) if not is_red[i]])]
+def find_red_points(X, Y, Y_hat, eps, ord, block_size=None):
+    Y, Y_hat = np.asarray(Y), np.asarray(Y_hat)
+    is_red = np.logical_and(
+            ~find_close_to_other_label(X, Y_hat, eps, ord, block_size=block_size),
+            Y_hat == Y)
+    red_pts = [X[is_red], Y[is_red]]
+    other_pts = [X[~is_red], Y[~is_red]]
 
     [X_red, Y_red] = [red_pts[0], red_pts[1]]
     [X_other, Y_other] = [other_pts[0], other_pts[1]]
@@ -66,7 +52,7 @@ def get_aug_v2(X, Y, Delta, delta, eps, ord):
     return X_train, Y_train
 
 class Robust_1NN():
-    def __init__(self, Delta, delta, ord, train_type='robust_v2'):
+    def __init__(self, Delta, delta, ord, train_type='robust_v2', block_size=None):
         #self.X = X
         #self.Y = Y * 2 -1 # to 1 -1
         self.ord = ord
@@ -74,6 +60,8 @@ class Robust_1NN():
         self.delta = delta
 
         self.train_type = train_type
+        # rows of each distance block in find_red_points
+        self.block_size = block_size
 
     def find_confident_label(self):
         [X, Y, k, delta, n] = [self.X, self.Y,
@@ -81,33 +69,21 @@ class Robust_1NN():
                                self.n]
         thres = 2*self.Delta
         #print(thres, k)
-        neigh = NearestNeighbors(k)
+        neigh = NearestNeighbors(n_neighbors=k)
         neigh.fit(X)
         nn = neigh.kneighbors(X, k, return_distance=False)
-        Y_hat = np.array([[Y[j] for j in i] for i in nn])
-        Y_hat = np.sum(Y_hat, axis=1)/k
-        Y_hat = [0 if (abs(Y_hat[i])<thres) else np.sign(Y_hat[i])
-                 for i in range(n)]
-        Y_hat = np.array(Y_hat)
+        Y_hat = Y[nn].sum(axis=1) / k
+        Y_hat = np.where(np.abs(Y_hat) < thres, 0, np.sign(Y_hat))
         self.Y_hat = Y_hat
         return Y_hat
 
     def find_red_points(self, eps):
-        [X, Y, d, r, F] = [self.X, self.Y, self.d, eps, self.Y_hat]
-        n = X.shape[0]
-        # TODO this fits only for L2 norm
-        is_close = (d<r)
-        is_red = np.ones((n, 1))
-        for i in range(n):
-            for j in range(n):
-                if (is_close[i, j]) and (F[i]!=F[j]):
-                    is_red[i]=0
-                if (F[i]!=Y[i]):
-                    is_red[i]=0
-        red_pts = [np.array([X[i] for i in range(n) if is_red[i]]),
-                  np.array([Y[i] for i in range(n) if is_red[i]])]
-        other_pts = [np.array([X[i] for i in range(n) if not is_red[i]]),
-                  np.array([Y[i] for i in range(n) if not is_red[i]])]
+        [X, Y, r, F] = [self.X, self.Y, eps, self.Y_hat]
+        is_red = np.logical_and(
+                ~find_close_to_other_label(X, F, r, self.ord, block_size=self.block_size),
+                F == Y)
+        red_pts = [X[is_red], Y[is_red]]
+        other_pts = [X[~is_red], Y[~is_red]]
         [self.X_red, self.Y_red] = [red_pts[0], red_pts[1]]
         [self.X_other, self.Y_other] = [other_pts[0], other_pts[1]]
         return [red_pts, other_pts]
@@ -137,8 +113,6 @@ class Robust_1NN():
             self.X = X
             self.Y = Y * 2 -1 # to 1 -1
             self.n = X.shape[0]
-            #self.d = np.array([[np.linalg.norm(a-b, ord=self.ord) for a in X] for b in X])
-            self.d = cdist(X, X, 'minkowski', self.ord)
             self.k = min(int(3*np.log(self.n/self.delta)/(np.log(2)*(self.Delta**2))), self.n)
 
             self.find_robust_training_set(eps)
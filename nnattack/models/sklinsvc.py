@@ -4,6 +4,7 @@ from cvxopt import matrix, solvers
 import cvxopt.glpk
 import cvxopt
 
+from ..attacks.base import PerturbationSet
 from .robust_nn.eps_separation import find_eps_separated_set
 from .sklr import get_sol_l2, get_sol_linf
 
@@ -64,13 +65,7 @@ class SkLinSVC(LinearSVC):
             pert_X[i, :] = pert_x
 
         if isinstance(eps, list):
-            rret = []
-            norms = np.linalg.norm(pert_X, axis=1, ord=self.ord)
-            for ep in eps:
-                t = np.copy(pert_X)
-                t[norms > ep, :] = 0
-                rret.append(t)
-            return rret
+            return PerturbationSet(pert_X, eps, self.ord)
         elif eps is not None:
             pert_X[np.linalg.norm(pert_X, axis=1, ord=self.ord) > eps, :] = 0
             return pert_X
@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_array_equal
+from scipy.sparse.csgraph import maximum_bipartite_matching
+from scipy.spatial.distance import cdist
+
+from nnattack.models.robust_nn.eps_separation import (
+    build_collision_graph, find_matching, find_eps_separated_set,
+    find_eps_separated_indices, find_eps_separated_indices_multi,
+)
+
+
+class TestEpsSeparation(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.X = random_state.rand(300, 2)
+        self.y = random_state.choice([-1, 1], size=300)
+
+    def test_matching(self):
+        for eps in [0.01, 0.03, 0.1]:
+            adj = build_collision_graph(eps, self.X, self.y, 2)
+            left = self.y > 0
+            match = find_matching(adj, left)
+
+            # a matching of adj, symmetric
+            matched = np.where(match != -1)[0]
+            assert_array_equal(matched, match[match[matched]])
+            self.assertTrue(np.all(adj[matched, match[matched]]))
+            self.assertTrue(np.all(left[matched] != left[match[matched]]))
+
+            # as large as the one of scipy
+            biadj = adj[np.where(left)[0]][:, np.where(~left)[0]]
+            size = (maximum_bipartite_matching(biadj, perm_type='column') != -1).sum()
+            self.assertEqual(size, left[matched].sum())
+
+    def test_eps_separated(self):
+        for ord in [1, 2, np.inf]:
+            for eps in [0.01, 0.03, 0.1]:
+                X, y = find_eps_separated_set(self.X, eps, self.y, ord)
+
+                # no pair of kept points of different labels within 2*eps
+                d = cdist(X, X, 'minkowski', p=ord)
+                self.assertTrue(np.all(d[y[:, np.newaxis] != y[np.newaxis]] > 2*eps))
+
+                # only a minimum vertex cover, as many points as the
+                # max-matching of scipy, is removed
+                adj = build_collision_graph(eps, self.X, self.y, ord)
+                left = self.y > 0
+                biadj = adj[np.where(left)[0]][:, np.where(~left)[0]]
+                size = (maximum_bipartite_matching(biadj, perm_type='column') != -1).sum()
+                self.assertEqual(len(self.X) - len(X), size)
+
+    def test_multi(self):
+        # unsorted, the warm started matchings give the same covers
+        eps_list = [0.05, 0.01, 0.1, 0.03]
+        for ord in [2, np.inf, 'min_measure']:
+            idxs = find_eps_separated_indices_multi(self.X, eps_list, self.y, ord)
+            self.assertEqual(len(eps_list), len(idxs))
+            for eps, idx in zip(eps_list, idxs):
+                assert_array_equal(find_eps_separated_indices(self.X, eps, self.y, ord), idx)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+"""
+Tensorflow session of an experiment, created when a model or attack needs it
+"""
+
+def get_session(auto_var):
+    """The 'sess' intermediate variable, the session is created, seeded with
+    random_seed and set as the keras session on the first call.
+
+    tensorflow and keras are only imported here, so experiments that never
+    ask for a session do not pay for their startup.
+    """
+    sess = auto_var.inter_var.get('sess')
+    if sess is not None:
+        return sess
+
+    import tensorflow as tf
+    import keras.backend
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+    tf.set_random_seed(auto_var.get_var("random_seed"))
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    sess = tf.Session(config=config)
+    keras.backend.set_session(sess)
+    keras.backend.set_learning_phase(0)
+    sess.run(tf.global_variables_initializer())
+    auto_var.set_intermidiate_variable("sess", sess)
+    return sess
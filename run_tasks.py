@@ -2,6 +2,8 @@ import os
 import logging
 import json
 
+from sklearn.model_selection import ParameterGrid
+
 from nnattack.variables import auto_var, get_file_name
 
 from params import (
@@ -32,11 +34,52 @@ from params import (
     lr_def,
     mlp_def,
 )
-from main import eps_accuracy
+from main import eps_accuracy, model_group_key, prepare_experiment, run_attack
+from scheduler import run_scheduled
 
 logging.basicConfig(level=logging.DEBUG)
 
 DEBUG = True if os.environ.get('DEBUG', False) else False
+# fit each model once and run all of its attacks against it
+GROUP_BY_MODEL = True if os.environ.get('GROUP_BY_MODEL', False) else False
+
+def run_grid_points(auto_var, params_list, experiment_fn, allow_failure=True):
+    """Runs experiment_fn on the grid points one after the other, each with
+    its own hooks and result file."""
+    results = []
+    for params in params_list:
+        auto_var.set_variable_value_by_dict(params)
+        try:
+            results.append(auto_var.run_single_experiment(experiment_fn))
+        except Exception:
+            if not allow_failure:
+                raise
+            logging.error("Error with " + str(params))
+            results.append(None)
+    return results
+
+def run_model_group(auto_var, group, allow_failure=True):
+    """Runs the grid points of a group, the first one that is not already
+    ran prepares the experiment for all of them."""
+    prepared = {}
+    def experiment_fn(auto_var):
+        if 'error' in prepared:
+            raise prepared['error']
+        if 'state' not in prepared:
+            try:
+                prepared['state'] = prepare_experiment(auto_var)
+            except Exception as e:
+                prepared['error'] = e
+                raise
+        return run_attack(auto_var, prepared['state'])
+    return run_grid_points(auto_var, group, experiment_fn, allow_failure)
+
+def group_by_model(grid_points):
+    """Grid points grouped by model_group_key."""
+    groups = {}
+    for params in grid_points:
+        groups.setdefault(model_group_key(params), []).append(params)
+    return list(groups.values())
 
 def main():
     experiments = [
@@ -71,15 +114,25 @@ def main():
             grid_params.extend(grid_param)
         else:
             grid_params.append(grid_param)
+    grid_points = [params for grid_param in grid_params
+                   for params in ParameterGrid(grid_param)]
 
     if DEBUG:
         run_param['n_jobs'] = 1
         run_param['allow_failure'] = False
     else:
-        run_param['n_jobs'] = 4
+        # n_jobs None uses the whole CPU budget, see nnattack.budget
+        run_param['n_jobs'] = None
         run_param['allow_failure'] = True
 
-    auto_var.run_grid_params(exp_fn, grid_params, **run_param)
+    if GROUP_BY_MODEL:
+        run_scheduled(auto_var, run_model_group, group_by_model(grid_points),
+                n_jobs=run_param['n_jobs'], verbose=run_param.get('verbose', 0),
+                allow_failure=run_param['allow_failure'])
+    else:
+        run_scheduled(auto_var, run_grid_points, [[p] for p in grid_points],
+                n_jobs=run_param['n_jobs'], verbose=run_param.get('verbose', 0),
+                experiment_fn=exp_fn, allow_failure=run_param['allow_failure'])
     #auto_var.run_grid_params(delete_file, grid_params, n_jobs=1,
     #                          with_hook=False, allow_failure=False)
     #auto_var.run_grid_params(celery_run, grid_params, n_jobs=1,
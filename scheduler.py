@@ -0,0 +1,162 @@
+"""
+Cost-aware scheduling of the experiment grid, longest runs first
+"""
+import os
+import re
+import glob
+import json
+import heapq
+import logging
+import time
+from copy import copy, deepcopy
+
+import numpy as np
+from joblib import Parallel
+
+from nnattack.budget import get_n_jobs, budgeted_delayed
+from nnattack.variables import get_file_name
+
+logger = logging.getLogger(__name__)
+
+# relative cost of an attack for 1000 points, from the number of neighbors k
+# and of searches s, the first matching pattern is used
+ATTACK_COSTS = [
+    ('rba_exact_knn', r"RBA_Exact_KNN_k(?P<k>\d+)", lambda k, s: 50. * 4 ** (k - 1)),
+    ('rba_approx_knn', r"RBA_Approx_KNN_k(?P<k>\d+)_(?P<s>\d+)", lambda k, s: .2 * k * s),
+    ('nnopt', r"(hybrid_|rev_)?nnopt_k(?P<k>\d+)_(?P<s>\d+)(_\d+)?", lambda k, s: .2 * k * s),
+    ('direct', r"direct_k(?P<k>\d+)", lambda k, s: .1 * k),
+    ('blackbox', r"blackbox", lambda k, s: 200.),
+    ('kernelsub', r"kernelsub_c\d+_\w+", lambda k, s: 20.),
+    ('gradient_based', r"gradient_based", lambda k, s: 30.),
+    ('rba_exact_rf', r"RBA_Exact_RF", lambda k, s: 300.),
+    ('milp_rf', r"MILP_RF", lambda k, s: 100.),
+    ('rba_approx_rf', r"RBA_Approx_RF(_(?P<s>\d+))?", lambda k, s: 2. * s),
+    ('rba_exact_dt', r"RBA_Exact_DT", lambda k, s: 5.),
+    ('dt_papernots', r"dt_papernots", lambda k, s: .5),
+    ('pgd', r"(kernel_sub_)?pgd", lambda k, s: 5.),
+    ('opt', r"sk\w+_opt", lambda k, s: 5.),
+]
+DEFAULT_ATTACK_COST = 10.
+DEFAULT_N_SEARCHES = 50
+
+# number of points of the datasets whose name does not give it
+DATASET_SIZES = {
+    'australian': 690, 'fourclass': 862, 'diabetes': 768, 'cancer': 683,
+    'german': 1000, 'splice': 1000, 'svmguide3': 1243, 'abalone': 1307,
+    'iris': 150, 'wine': 178, 'digits': 1797,
+    'mnist17f': 13007, 'fashion_mnist35f': 12000, 'fashion_mnist06f': 12000,
+    'fullmnist': 60000, 'fullfashion': 60000, 'cifar': 50000,
+}
+DEFAULT_DATASET_SIZE = 1000
+
+def dataset_size(dataset):
+    for name in sorted(DATASET_SIZES, key=len, reverse=True):
+        if dataset.startswith(name):
+            return DATASET_SIZES[name]
+    m = re.search(r"_(\d+)", dataset)
+    return int(m.group(1)) if m else DEFAULT_DATASET_SIZE
+
+def attack_family(attack):
+    """Name and relative cost of an attack variable string."""
+    for family, pattern, cost_fn in ATTACK_COSTS:
+        m = re.fullmatch(pattern, attack)
+        if m is not None:
+            groups = m.groupdict()
+            k = int(groups.get('k') or 1)
+            s = int(groups.get('s') or DEFAULT_N_SEARCHES)
+            return family, cost_fn(k, s)
+    return None, DEFAULT_ATTACK_COST
+
+def heuristic_cost(params):
+    _, cost = attack_family(params['attack'])
+    return cost * dataset_size(params['dataset']) / 1000
+
+class CostModel():
+    """Estimated running time of a grid point, the heuristic cost times the
+    median ratio of running time to heuristic cost among the finished runs
+    of the same attack family (of all finished runs if there is none).
+
+    Arguments:
+        result_dir {str} -- Directory of the result files with their running_time
+    """
+    def __init__(self, result_dir):
+        ratios = {}
+        for file_path in glob.glob(os.path.join(result_dir, '*.json')):
+            try:
+                with open(file_path, 'r') as f:
+                    ret = json.load(f)
+                params, running_time = ret['var_value'], ret['running_time']
+                ratio = running_time / heuristic_cost(params)
+            except (OSError, ValueError, TypeError, KeyError, ZeroDivisionError):
+                continue
+            family, _ = attack_family(params['attack'])
+            ratios.setdefault(family, []).append(ratio)
+        self.n_runs = sum(len(r) for r in ratios.values())
+        self.scales = {k: float(np.median(r)) for k, r in ratios.items()}
+        self.default_scale = float(np.median(sum(ratios.values(), []))) \
+                if self.n_runs else 1.
+
+    def __call__(self, params):
+        family, _ = attack_family(params['attack'])
+        return heuristic_cost(params) * self.scales.get(family, self.default_scale)
+
+def lpt_makespan(costs, n_workers):
+    """Makespan of running costs longest first on n_workers."""
+    workers = [0.] * max(1, min(n_workers, len(costs)))
+    for cost in sorted(costs, reverse=True):
+        heapq.heappush(workers, heapq.heappop(workers) + cost)
+    return max(workers) if costs else 0.
+
+def result_path(auto_var, params):
+    """Result file the hooks write for a grid point."""
+    grid_auto_var = copy(auto_var)
+    grid_auto_var.var_value = dict(auto_var.var_value, **params)
+    return os.path.join(auto_var.settings['result_file_dir'],
+                        get_file_name(grid_auto_var) + '.json')
+
+def run_scheduled(auto_var, task_fn, tasks, n_jobs=None, verbose=0,
+        **task_kwargs):
+    """Runs task_fn(auto_var, params_list, **task_kwargs) for each list of
+    grid points of tasks in a process pool, the most expensive tasks first.
+
+    The grid points with a result file already are left out, the cost of a
+    task is the sum of the costs of its grid points. The expected remaining
+    makespan is logged as the results come back, in the dispatch order.
+
+    Keyword Arguments:
+        n_jobs {int} -- Number of processes, the whole CPU budget if None, the tasks share the budget (default: {None})
+
+    Returns:
+        list -- the return values of task_fn, in the order of tasks
+    """
+    n_jobs = get_n_jobs(n_jobs)
+    cost_model = CostModel(auto_var.settings['result_file_dir'])
+
+    todo = []
+    for i, params_list in enumerate(tasks):
+        params_list = [p for p in params_list
+                       if not os.path.exists(result_path(auto_var, p))]
+        if params_list:
+            todo.append((sum(cost_model(p) for p in params_list), i, params_list))
+    todo.sort(key=lambda t: -t[0])
+
+    logger.info("%d tasks (%d grid points) on %d processes, %d finished runs "
+                "in the cost model, expected makespan %.0fs",
+                len(todo), sum(len(t[2]) for t in todo), n_jobs,
+                cost_model.n_runs, lpt_makespan([t[0] for t in todo], n_jobs))
+    start_time = time.time()
+    # one task per batch keeps the longest first order of the dispatch
+    rets = Parallel(n_jobs=n_jobs, verbose=verbose, batch_size=1,
+                    return_as="generator")(
+        budgeted_delayed(task_fn, n_jobs)(deepcopy(auto_var), params_list,
+                                          **task_kwargs)
+        for _, _, params_list in todo)
+
+    results = [None] * len(tasks)
+    for k, ((_, i, _), ret) in enumerate(zip(todo, rets)):
+        results[i] = ret
+        left = [t[0] for t in todo[k+1:]]
+        logger.info("%d tasks left, expected remaining makespan %.0fs",
+                    len(left), lpt_makespan(left, n_jobs))
+    logger.info("grid finished in %.0fs", time.time() - start_time)
+    return results
@@ -1,35 +1,15 @@
 #!/usr/bin/env python
-#cython: language_level=3
 
 import os
-from setuptools import setup, Extension
+from setuptools import setup
 import sys
 
-from Cython.Build import cythonize
-from Cython.Distutils import build_ext
-import numpy
-import numpy.distutils
-
-extra_link_args = ['-L/usr/lib/x86_64-linux-gnu/']
-include_dirs = numpy.distutils.misc_util.get_numpy_include_dirs()
-
-extensions = cythonize(
-    Extension(
-        "nnattack.attacks.nns.cutils",
-        ["nnattack/attacks/nns/cutils.pyx"],
-        extra_link_args=extra_link_args,
-        extra_compile_args=['-std=c11'],
-        include_dirs=include_dirs,
-    ),
-)
-cmdclasses = {'build_ext': build_ext}
 setup_requires = [
 ]
 install_requires = [
     'numpy',
     'scipy',
     'scikit-learn',
-    'Cython',
     'joblib',
     'six',
     'cvxopt',
@@ -49,7 +29,6 @@ setup(
     author='Y.-Y. Yang',
     author_email='',
     url='',
-    cmdclass=cmdclasses,
     setup_requires=setup_requires,
     install_requires=install_requires,
     tests_require=tests_require,
@@ -64,5 +43,4 @@ setup(
     ],
     package_dir={
     },
-    ext_modules=extensions,
 )
@@ -0,0 +1,70 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_almost_equal
+from sklearn.neighbors import KNeighborsClassifier
+
+from main import (
+    estimate_model_roubstness, eps_sweep_accuracy, is_eps_masked, model_group_key,
+)
+
+
+class TestEpsSweep(unittest.TestCase):
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        trnX = random_state.rand(200, 2)
+        trny = (trnX[:, 0] > trnX[:, 1]).astype(int)
+        self.model = KNeighborsClassifier(n_neighbors=3).fit(trnX, trny)
+        self.X = random_state.rand(100, 2)
+        self.y = self.model.predict(self.X)
+        self.perts = random_state.randn(100, 2) * 0.1
+        self.eps_list = [0.02 * i for i in range(16)]
+
+    def predict_loop(self, perturbs):
+        return [(self.model.predict(self.X + pert) == self.y).mean() for pert in perturbs]
+
+    def test_masked(self):
+        for ord in [1, 2, np.inf]:
+            norms = np.linalg.norm(self.perts, axis=1, ord=ord)
+            perturbs = np.array([np.where((norms <= eps)[:, np.newaxis], self.perts, 0)
+                                 for eps in self.eps_list])
+            self.assertTrue(is_eps_masked(perturbs, self.perts, self.eps_list, ord))
+
+            expected = self.predict_loop(perturbs)
+            ret = eps_sweep_accuracy(self.model, self.X, self.y, self.perts,
+                                     self.eps_list, ord)
+            assert_almost_equal(expected, [r['tst_acc'] for r in ret])
+            ret = estimate_model_roubstness(self.model, self.X, self.y, perturbs,
+                                            self.eps_list, ord, perts=self.perts)
+            assert_almost_equal(expected, [r['tst_acc'] for r in ret])
+            self.assertEqual(self.eps_list, [r['eps'] for r in ret])
+
+    def test_unmasked(self):
+        # perturbations scaled down to eps are not masked copies of perts
+        for ord in [1, 2, np.inf]:
+            norms = np.linalg.norm(self.perts, axis=1, ord=ord)
+            perturbs = np.array([
+                self.perts * np.minimum(1, eps / norms)[:, np.newaxis]
+                for eps in self.eps_list])
+            self.assertFalse(is_eps_masked(perturbs, self.perts, self.eps_list, ord))
+
+            ret = estimate_model_roubstness(self.model, self.X, self.y, perturbs,
+                                            self.eps_list, ord, perts=self.perts)
+            assert_almost_equal(self.predict_loop(perturbs), [r['tst_acc'] for r in ret])
+
+class TestModelGroupKey(unittest.TestCase):
+    def key(self, model, attack):
+        return model_group_key({'dataset': 'iris', 'ord': 2, 'model': model,
+                                'random_seed': 0, 'attack': attack})
+
+    def test_attack_in_key(self):
+        for model in ['adv_nn_k1_10', 'adv2_sklr_10', 'kernel_sub_tf_xvalid_10',
+                      'advPruning_kernel_sub_tf_xvalid_10']:
+            self.assertNotEqual(self.key(model, 'kernel_sub_pgd'),
+                                self.key(model, 'blackbox'))
+        for model in ['knn1', 'advPruning_nn_k1_10', 'random_forest_100_d5']:
+            self.assertEqual(self.key(model, 'kernel_sub_pgd'),
+                             self.key(model, 'blackbox'))
+
+if __name__ == '__main__':
+    unittest.main()
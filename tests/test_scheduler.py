@@ -0,0 +1,78 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from scheduler import (
+    CostModel, attack_family, dataset_size, heuristic_cost, lpt_makespan,
+)
+
+
+class TestAttackFamily(unittest.TestCase):
+    def test_family(self):
+        self.assertEqual(('rba_exact_knn', 50. * 4 ** 2), attack_family('RBA_Exact_KNN_k3'))
+        self.assertEqual(('rba_approx_knn', .2 * 3 * 20), attack_family('RBA_Approx_KNN_k3_20'))
+        self.assertEqual(('nnopt', .2 * 1 * 50), attack_family('hybrid_nnopt_k1_50_2'))
+        self.assertEqual(('rba_exact_rf', 300.), attack_family('RBA_Exact_RF'))
+        self.assertEqual(('milp_rf', 100.), attack_family('MILP_RF'))
+        self.assertEqual(('rba_approx_rf', 2. * 50), attack_family('RBA_Approx_RF'))
+        self.assertEqual(('rba_approx_rf', 2. * 10), attack_family('RBA_Approx_RF_10'))
+        self.assertEqual(('pgd', 5.), attack_family('kernel_sub_pgd'))
+        self.assertEqual((None, 10.), attack_family('unknown_attack'))
+
+class TestDatasetSize(unittest.TestCase):
+    def test_size(self):
+        self.assertEqual(150, dataset_size('iris'))
+        # the longest matching name
+        self.assertEqual(60000, dataset_size('fullmnist_pca5'))
+        self.assertEqual(13007, dataset_size('mnist17f_pca25'))
+        self.assertEqual(2200, dataset_size('halfmoon_2200'))
+        self.assertEqual(1000, dataset_size('unknown'))
+
+class TestLptMakespan(unittest.TestCase):
+    def test_makespan(self):
+        self.assertEqual(0., lpt_makespan([], 4))
+        self.assertEqual(15., lpt_makespan([3., 10., 2.], 1))
+        self.assertEqual(10., lpt_makespan([3., 10., 2.], 8))
+        # 7 | 5 + 3 | 4 + 3
+        self.assertEqual(8., lpt_makespan([3., 3., 4., 5., 7.], 3))
+
+class TestCostModel(unittest.TestCase):
+    def setUp(self):
+        self.result_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.result_dir)
+
+    def write_result(self, name, attack, running_time):
+        with open(os.path.join(self.result_dir, name + '.json'), 'w') as f:
+            json.dump({'var_value': {'attack': attack, 'dataset': 'iris'},
+                       'running_time': running_time}, f)
+
+    def test_no_runs(self):
+        cost_model = CostModel(self.result_dir)
+        params = {'attack': 'RBA_Exact_RF', 'dataset': 'halfmoon_2000'}
+        self.assertEqual(0, cost_model.n_runs)
+        self.assertEqual(heuristic_cost(params), cost_model(params))
+
+    def test_scales(self):
+        # iris has 150 points, the heuristic costs are 15 and 0.015
+        for i, running_time in enumerate([15., 30., 60.]):
+            self.write_result('milp%d' % i, 'MILP_RF', running_time)
+        self.write_result('direct', 'direct_k1', 0.15)
+        with open(os.path.join(self.result_dir, 'broken.json'), 'w') as f:
+            f.write('{')
+        cost_model = CostModel(self.result_dir)
+
+        self.assertEqual(4, cost_model.n_runs)
+        self.assertAlmostEqual(2. * 100.,
+            cost_model({'attack': 'MILP_RF', 'dataset': 'halfmoon_1000'}))
+        self.assertAlmostEqual(10. * .1 * 2,
+            cost_model({'attack': 'direct_k2', 'dataset': 'halfmoon_1000'}))
+        # median of the ratios of all runs for the families without one
+        self.assertAlmostEqual(3. * 300.,
+            cost_model({'attack': 'RBA_Exact_RF', 'dataset': 'halfmoon_1000'}))
+
+if __name__ == '__main__':
+    unittest.main()